@@ -0,0 +1,180 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional
+
+from PIL import Image
+
+# Server-side OCR of whole batches. Pages run in WORKERS worker processes,
+# each owned by one dispatcher thread. Workers are started with "spawn"
+# (forking the threaded server can copy held locks into the child). Every
+# page gets a time budget: the worker stops OCRing zones once it is spent,
+# and a worker still busy KILL_GRACE seconds later is killed and replaced,
+# so one hung page cannot stall the batch or later ones.
+WORKERS = int(os.environ.get("BATCH_OCR_WORKERS", os.cpu_count() or 1))
+PAGE_TIMEOUT = float(os.environ.get("BATCH_OCR_PAGE_TIMEOUT", 60))
+KILL_GRACE = 5  # seconds
+
+_context = multiprocessing.get_context("spawn")
+_local = threading.local()  # the dispatcher thread's worker
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="batch-ocr")
+        return _executor
+
+
+def _worker_main(conn):
+    while True:
+        try:
+            args = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send(("ok", ocr_page_file(*args)))
+        except Exception as e:
+            conn.send(("error", str(e)))
+
+
+class _Worker:
+    def __init__(self):
+        self.conn, child = _context.Pipe()
+        self.process = _context.Process(target=_worker_main, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+def _run_page(image_path: str, zones: List[dict], lang: str, preset: str,
+              timeout: Optional[float], table: Optional[dict]) -> dict:
+    """OCR one page in this dispatcher thread's worker, killing it when it overruns."""
+    worker = getattr(_local, "worker", None)
+    if worker is None or not worker.process.is_alive():
+        worker = _local.worker = _Worker()
+
+    limit = None if timeout is None else timeout + KILL_GRACE
+    try:
+        worker.conn.send((image_path, zones, lang, preset, timeout, table))
+        if not worker.conn.poll(limit):
+            print(f"[OCR] Batch page {os.path.basename(image_path)} still running after {limit:.0f}s, "
+                  f"restarting its worker")
+            worker.kill()
+            _local.worker = None
+            return {"values": {}, "confidence": {}, "timedOut": True}
+        status, payload = worker.conn.recv()
+    except (EOFError, OSError):
+        worker.kill()
+        _local.worker = None
+        raise RuntimeError("OCR worker exited")
+    if status == "error":
+        raise RuntimeError(payload)
+    return payload
+
+
+def ocr_page_file(image_path: str, zones: List[dict], lang: str, preset: str,
+                  timeout: Optional[float] = PAGE_TIMEOUT, table: Optional[dict] = None) -> dict:
+    """OCR one page image against the profile zones (runs in a worker process).
+
+    Zones are recognised until the page's time budget is spent; the remaining
+    ones are left out and the page is flagged with timedOut. A timeout of
+    None means no budget.
+    """
+    import item_table
+    import ocr_cache
+    import page_source
+    from routers.ocr import Zone, ocr_items, ocr_zone, prepare_page, scale_zone
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    def overdue() -> bool:
+        return deadline is not None and time.monotonic() > deadline
+
+    if not page_source.ensure_page(image_path):
+        raise FileNotFoundError(image_path)
+    with open(image_path, "rb") as f:
+        image_bytes = f.read()
+    image_hash = ocr_cache.content_hash(image_bytes)
+    pil_image = Image.open(image_path)
+    pil_image.load()
+    pil_image, image_hash, scale, _ = prepare_page(pil_image, image_hash, preset)
+
+    values = {}
+    confidence = {}
+    for z in zones:
+        if overdue():
+            return {"values": values, "confidence": confidence, "timedOut": True}
+        result = ocr_zone(pil_image, scale_zone(Zone(**z), scale), image_hash, lang)
+        if result.success:
+            values[result.propertyName] = result.text
+            confidence[result.propertyName] = result.confidence
+    page = {"values": values, "confidence": confidence, "timedOut": False}
+    if table:
+        if overdue():
+            page["timedOut"] = True
+        else:
+            page["invoiceItems"] = ocr_items(pil_image, item_table.scale_table(table, scale), image_hash, lang)
+    return page
+
+
+async def ocr_pages(image_paths: List[str], zones: List[dict], lang: str, preset: str,
+                    timeout: Optional[float] = PAGE_TIMEOUT, table: Optional[dict] = None) -> List[dict]:
+    """OCR every page in the worker pool without blocking the event loop.
+
+    Results come back in input order. A page whose worker fails gets an
+    empty result with an error message; one that overruns its budget is
+    flagged with timedOut.
+    """
+    executor = get_executor()
+    futures = [
+        asyncio.wrap_future(executor.submit(_run_page, path, zones, lang, preset, timeout, table))
+        for path in image_paths
+    ]
+    outcomes = await asyncio.gather(*futures, return_exceptions=True)
+
+    results = []
+    for path, outcome in zip(image_paths, outcomes):
+        if isinstance(outcome, Exception):
+            print(f"[OCR] Batch page {os.path.basename(path)} failed: {outcome}")
+            outcome = {"values": {}, "confidence": {}, "timedOut": False, "error": str(outcome)}
+        results.append(outcome)
+    return results
+
+
+def iter_pages(image_paths: List[str], zones: List[dict], lang: str, preset: str,
+               timeout: Optional[float] = PAGE_TIMEOUT, table: Optional[dict] = None, cancelled=None):
+    """Yield (index, result) as pages finish, for background jobs.
+
+    Pages not started yet are cancelled once cancelled() returns True.
+    """
+    executor = get_executor()
+    futures = {
+        executor.submit(_run_page, path, zones, lang, preset, timeout, table): i
+        for i, path in enumerate(image_paths)
+    }
+    pending = set(futures)
+    try:
+        for future in as_completed(futures):
+            pending.discard(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"[OCR] Batch page {os.path.basename(image_paths[futures[future]])} failed: {e}")
+                result = {"values": {}, "confidence": {}, "timedOut": False, "error": str(e)}
+            yield futures[future], result
+            if cancelled is not None and cancelled():
+                return
+    finally:
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,130 @@
+import hashlib
+import os
+import re
+import shutil
+
+import storage
+
+# Content-addressed storage for queue page images. A blob is stored once under
+# its sha256 and hard-linked into every queue folder that uses it, so readers
+# keep opening data/queues/<name>/<filename> while identical pages share one
+# copy on disk. A blob whose only remaining link is the store's own is no
+# longer used by any queue and is removed by release(). Storing, linking and
+# releasing a blob hold its storage lock, which several workers share.
+#
+# Backups leave BLOB_DIR out, since every blob is also in a queue folder. When
+# the store is missing at start-up (a restored backup) the queue files listed
+# in the queue meta.json files are linked back into it by restore_links().
+BLOB_DIR = "data/blobs"
+QUEUE_DIR = "data/queues"
+CHUNK_SIZE = 1024 * 1024
+
+_SHA_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_hash(value: str) -> bool:
+    return isinstance(value, str) and bool(_SHA_RE.match(value))
+
+
+def blob_path(sha: str) -> str:
+    if not is_hash(sha):
+        raise ValueError(f"Invalid blob hash '{sha}'")
+    return os.path.join(BLOB_DIR, sha[:2], sha)
+
+
+def exists(sha: str) -> bool:
+    return is_hash(sha) and os.path.exists(blob_path(sha))
+
+
+def put(fileobj) -> str:
+    """Store the stream's content and return its sha256; known content is not written twice."""
+    digest = hashlib.sha256()
+    # The name is only known once the content is hashed
+    tmp_path = storage.temp_path(os.path.join(BLOB_DIR, "upload"))
+    try:
+        with open(tmp_path, "wb") as f:
+            while True:
+                chunk = fileobj.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+        sha = digest.hexdigest()
+        path = blob_path(sha)
+        with storage.locked(path, "blobs"):
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return sha
+
+
+def link(sha: str, dest: str):
+    """Make dest a link to the blob (a copy where hard links are not supported)."""
+    path = blob_path(sha)
+    with storage.locked(path, "blobs"):
+        if os.path.exists(dest):
+            if os.path.samefile(path, dest):
+                return
+            os.remove(dest)
+        try:
+            os.link(path, dest)
+        except OSError:
+            shutil.copyfile(path, dest)
+
+
+def adopt(sha: str, path: str):
+    """Share an existing queue file with the blob it holds, storing the file as the blob if it is missing."""
+    blob = blob_path(sha)
+    with storage.locked(blob, "blobs"):
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                os.link(path, blob)
+            except OSError:
+                shutil.copyfile(path, blob)
+        elif not os.path.samefile(blob, path):
+            link(sha, path)
+
+
+def restore_links(queue_dir: str = QUEUE_DIR) -> int:
+    """Link the page images of every queue back into the store; returns how many files were adopted."""
+    adopted = 0
+    for name in sorted(os.listdir(queue_dir)) if os.path.isdir(queue_dir) else []:
+        queue_path = os.path.join(queue_dir, name)
+        try:
+            blobs = storage.read_json(os.path.join(queue_path, "meta.json")).get("blobs", {})
+        except (OSError, ValueError):
+            continue
+        for filename, sha in blobs.items():
+            path = os.path.join(queue_path, os.path.basename(filename))
+            if not is_hash(sha) or not os.path.isfile(path):
+                continue
+            try:
+                adopt(sha, path)
+                adopted += 1
+            except OSError as e:
+                print(f"[BLOBS] Cannot restore {path}: {e}")
+    if adopted:
+        print(f"[BLOBS] Restored {adopted} queue images into {BLOB_DIR}")
+    return adopted
+
+
+def release(sha: str):
+    """Remove a blob once no queue folder links to it any more."""
+    if not is_hash(sha):
+        return
+    path = blob_path(sha)
+    with storage.locked(path, "blobs"):
+        try:
+            if os.stat(path).st_nlink <= 1:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+if not os.path.isdir(BLOB_DIR):
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    restore_links()
@@ -0,0 +1,64 @@
+from typing import Optional
+
+# OCR settings per zone field type. Typed fields go straight to a single-line
+# pass with a character whitelist and one language model; only free text uses
+# the profile's full language set.
+DEFAULT_LANG = "ces+eng+deu+pol"
+
+DIGITS = "0123456789"
+UPPER = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+FIELD_TYPES = {
+    "amount": {"lang": "eng", "psm": 7, "whitelist": DIGITS + ",.-"},
+    "date": {"lang": "eng", "psm": 7, "whitelist": DIGITS + "./-"},
+    "iban": {"lang": "eng", "psm": 7, "whitelist": UPPER + DIGITS + "/-"},
+    "vat_id": {"lang": "eng", "psm": 7, "whitelist": UPPER + DIGITS},
+    "number": {"lang": "eng", "psm": 7, "whitelist": DIGITS},
+    "text": {"lang": None, "psm": None, "whitelist": None},
+}
+
+# FlexiBee property names whose type is obvious, used when a zone has no fieldType
+_EXACT_HINTS = {
+    "osv": "amount",
+    "kurz": "amount",
+    "cenaMj": "amount",
+    "mnozMj": "amount",
+    "slevaDokl": "amount",
+    "iban": "iban",
+    "buc": "iban",
+    "dic": "vat_id",
+    "ic": "number",
+    "varSym": "number",
+    "specSym": "number",
+    "konSym": "number",
+    "psc": "number",
+}
+_PREFIX_HINTS = (
+    ("sum", "amount"),
+    ("szb", "amount"),
+    ("dat", "date"),
+    ("duzp", "date"),
+)
+
+
+def infer_field_type(property_name: str) -> str:
+    if property_name in _EXACT_HINTS:
+        return _EXACT_HINTS[property_name]
+    for prefix, field_type in _PREFIX_HINTS:
+        if property_name.startswith(prefix):
+            return field_type
+    return "text"
+
+
+def resolve(field_type: Optional[str], property_name: str) -> str:
+    """Return the effective field type of a zone."""
+    if field_type in FIELD_TYPES:
+        return field_type
+    return infer_field_type(property_name)
+
+
+def ocr_config(field_type: str, profile_lang: str = DEFAULT_LANG) -> dict:
+    config = dict(FIELD_TYPES.get(field_type, FIELD_TYPES["text"]))
+    if config["lang"] is None:
+        config["lang"] = profile_lang
+    return config
@@ -0,0 +1,95 @@
+import mimetypes
+import os
+import threading
+from typing import Optional
+
+from fastapi import HTTPException, Request
+from fastapi.responses import FileResponse, Response
+from PIL import Image
+
+import storage
+
+# Page images are served with ETags so browsers revalidate instead of
+# downloading them again. Downscaled WebP derivatives are built on first
+# request and stored in a .derivatives folder next to the original. Queue
+# pages are hard links to blobs, so a replaced page can have an older mtime
+# than the one before it: ETags and derivative names include the inode.
+DERIVATIVE_DIR = ".derivatives"
+DERIVATIVE_WIDTHS = {
+    "thumb": 320,
+    "preview": 1280,
+}
+WEBP_QUALITY = 80
+
+# Files that never change once written (temp batch pages) can be cached for
+# a day; everything else is revalidated on every use.
+IMMUTABLE = "private, max-age=86400, immutable"
+REVALIDATE = "private, no-cache"
+
+_lock = threading.Lock()
+
+
+def _signature(path: str) -> str:
+    stat = os.stat(path)
+    return f"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+
+def etag_for(path: str) -> str:
+    return f'"{_signature(path)}"'
+
+
+def derivative_path(path: str, size: str) -> str:
+    """Derivative of the file's current content; a replaced file gets a new name."""
+    directory, filename = os.path.split(path)
+    return os.path.join(directory, DERIVATIVE_DIR, f"{filename}.{size}.{_signature(path)}.webp")
+
+
+def ensure_derivative(path: str, size: str) -> str:
+    """Return the path of a downscaled WebP copy, building it when missing."""
+    out_path = derivative_path(path, size)
+    if os.path.exists(out_path):
+        return out_path
+
+    with _lock:
+        if os.path.exists(out_path):
+            return out_path
+        out_dir = os.path.dirname(out_path)
+        os.makedirs(out_dir, exist_ok=True)
+        # Derivatives of earlier versions of the file are of no further use
+        prefix = f"{os.path.basename(path)}.{size}."
+        for name in os.listdir(out_dir):
+            if name.startswith(prefix) and name.endswith(".webp"):
+                try:
+                    os.remove(os.path.join(out_dir, name))
+                except FileNotFoundError:
+                    pass
+        width = DERIVATIVE_WIDTHS[size]
+        with Image.open(path) as image:
+            image = image.convert("RGB") if image.mode not in ("RGB", "L") else image
+            if image.width > width:
+                image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+            with storage.open_atomic(out_path, fsync=False) as f:
+                image.save(f, format="WEBP", quality=WEBP_QUALITY)
+    return out_path
+
+
+def serve_image(request: Request, path: str, size: Optional[str] = None,
+                cache_control: str = REVALIDATE) -> Response:
+    """Serve an image (or one of its derivatives) with ETag, 304 and Range support."""
+    if size is not None:
+        if size not in DERIVATIVE_WIDTHS:
+            raise HTTPException(status_code=400, detail=f"Unknown size '{size}'")
+        path = ensure_derivative(path, size)
+        media_type = "image/webp"
+    else:
+        media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    etag = etag_for(path)
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [t.strip() for t in if_none_match.split(",")]
+        if "*" in tags or etag in tags:
+            return Response(status_code=304, headers=headers)
+    # FileResponse answers Range requests itself
+    return FileResponse(path, media_type=media_type, headers=headers)
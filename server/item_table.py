@@ -0,0 +1,99 @@
+from typing import List, Optional
+
+import numpy as np
+from PIL import Image
+
+# Invoice line items from one item-block region. Row separators come from the
+# horizontal projection profile of the block, the block is recognised once
+# and words are assigned to (row, column) cells by their centre point.
+#
+# A profile's itemTable setting looks like:
+#   {"x": 80, "y": 900, "width": 2300, "height": 1200,
+#    "columns": [{"propertyName": "nazev", "x": 80, "width": 1200}, ...]}
+# Column x values are page coordinates, like zones.
+INK_THRESHOLD = 128
+MIN_ROW_INK = 2  # dark pixels a scanline needs to count as text
+MIN_ROW_GAP = 6  # blank scanlines that separate two rows
+MIN_ROW_HEIGHT = 6
+
+
+def validate(table: dict):
+    """Raise ValueError when an itemTable setting is malformed."""
+    if not isinstance(table, dict) or not isinstance(table.get("columns", []), list):
+        raise ValueError("itemTable must be an object with a columns list")
+    for key in ("x", "y", "width", "height", "columns"):
+        if key not in table:
+            raise ValueError(f"itemTable is missing '{key}'")
+    if not table["columns"]:
+        raise ValueError("itemTable needs at least one column")
+    for column in table["columns"]:
+        for key in ("propertyName", "x", "width"):
+            if key not in column:
+                raise ValueError(f"itemTable column is missing '{key}'")
+
+
+def scale_table(table: dict, scale: float) -> dict:
+    if scale == 1.0:
+        return table
+    scaled = {k: round(table[k] * scale) for k in ("x", "y", "width", "height")}
+    scaled["columns"] = [
+        {**c, "x": round(c["x"] * scale), "width": round(c["width"] * scale)} for c in table["columns"]
+    ]
+    return scaled
+
+
+def find_row_bands(gray: np.ndarray, min_gap: int = MIN_ROW_GAP, min_height: int = MIN_ROW_HEIGHT):
+    """Return (top, bottom) scanline ranges of text rows in a grayscale block."""
+    ink = (gray < INK_THRESHOLD).sum(axis=1) >= MIN_ROW_INK
+    if not ink.any():
+        return []
+    # Close gaps narrower than min_gap so one text row is one band
+    edges = np.diff(np.concatenate(([0], ink.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    keep = np.concatenate(([True], starts[1:] - ends[:-1] >= min_gap))
+    band_starts = starts[keep]
+    band_ends = np.concatenate((ends[:-1][keep[1:]], [ends[-1]]))
+    return [(int(s), int(e)) for s, e in zip(band_starts, band_ends) if e - s >= min_height]
+
+
+def _cell_of(word: dict, bands, columns) -> Optional[tuple]:
+    cy = word["top"] + word["height"] / 2
+    cx = word["left"] + word["width"] / 2
+    row = next((i for i, (top, bottom) in enumerate(bands) if top <= cy < bottom), None)
+    col = next((j for j, c in enumerate(columns) if c["x"] <= cx < c["x"] + c["width"]), None)
+    if row is None or col is None:
+        return None
+    return row, col
+
+
+def extract_items(pil_image: Image.Image, table: dict, recognize_words) -> List[dict]:
+    """Detect rows in the item block and return one dict per row.
+
+    recognize_words(block_image, crop_box) runs OCR on the block and returns
+    word boxes relative to the block (see ocr_engine.image_to_data).
+    """
+    crop_box = (table["x"], table["y"], table["x"] + table["width"], table["y"] + table["height"])
+    block = pil_image.crop(crop_box)
+    bands = find_row_bands(np.asarray(block.convert("L")))
+    if not bands:
+        return []
+
+    # Column bounds relative to the block
+    columns = [{**c, "x": c["x"] - table["x"]} for c in table["columns"]]
+    cells = [[[] for _ in columns] for _ in bands]
+    for word in recognize_words(block, crop_box):
+        cell = _cell_of(word, bands, columns)
+        if cell is not None:
+            cells[cell[0]][cell[1]].append(word)
+
+    items = []
+    for row in cells:
+        if not any(row):
+            continue
+        item = {}
+        for column, words in zip(columns, row):
+            words = sorted(words, key=lambda w: (w["top"], w["left"]))
+            item[column["propertyName"]] = " ".join(w["text"] for w in words)
+        items.append(item)
+    return items
@@ -0,0 +1,192 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Optional
+
+import jobs
+import ocr_cache
+import page_cache
+
+# Background clean-up of temp_batches. A batch is deleted once it has not been
+# accessed for TTL seconds; when the batches together exceed the quota the
+# least recently accessed ones go first. Pinned batches (a .pinned marker in
+# the batch folder) are never removed. Short-lived converter output lives in
+# SCRATCH_DIR and is swept with its own, shorter TTL. Every pass also keeps
+# the OCR disk cache within its budget and removes expired background jobs
+# and page sessions.
+TEMP_DIR = "temp_batches"
+SCRATCH_DIR = os.path.join(TEMP_DIR, ".scratch")
+TTL_SECONDS = float(os.environ.get("TEMP_BATCH_TTL_HOURS", 72)) * 3600
+QUOTA_BYTES = int(os.environ.get("TEMP_BATCH_QUOTA_MB", 10240)) * 1024 * 1024
+SCRATCH_TTL_SECONDS = float(os.environ.get("SCRATCH_TTL_MINUTES", 60)) * 60
+INTERVAL_SECONDS = float(os.environ.get("JANITOR_INTERVAL", 600))
+# Batches younger than this are still being uploaded or reviewed; the quota never evicts them
+MIN_AGE_SECONDS = 15 * 60
+PIN_MARKER = ".pinned"
+TOUCH_INTERVAL = 60  # seconds between access-time updates of the same batch
+
+os.makedirs(SCRATCH_DIR, exist_ok=True)
+
+_lock = threading.Lock()
+_last_touch = {}
+_thread = None
+_stop = threading.Event()
+_stats = {"lastRun": None, "evictedTtl": 0, "evictedQuota": 0, "scratchRemoved": 0, "freedBytes": 0}
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def touch(batch_id: str):
+    """Record an access to a batch; its folder mtime is the last-access time."""
+    now = time.time()
+    if now - _last_touch.get(batch_id, 0) < TOUCH_INTERVAL:
+        return
+    _last_touch[batch_id] = now
+    try:
+        os.utime(os.path.join(TEMP_DIR, batch_id))
+    except OSError:
+        pass
+
+
+def is_pinned(batch_id: str) -> bool:
+    return os.path.exists(os.path.join(TEMP_DIR, batch_id, PIN_MARKER))
+
+
+def pin(batch_id: str, pinned: bool = True):
+    marker = os.path.join(TEMP_DIR, batch_id, PIN_MARKER)
+    if pinned:
+        open(marker, "a").close()
+    elif os.path.exists(marker):
+        os.remove(marker)
+
+
+def scratch_dir(prefix: str) -> str:
+    """A fresh folder for temporary converter output, removed by the janitor if left behind."""
+    os.makedirs(SCRATCH_DIR, exist_ok=True)
+    return tempfile.mkdtemp(prefix=f"{prefix}-", dir=SCRATCH_DIR)
+
+
+def batches():
+    """Return one dict per batch with id, size, last access and pin state."""
+    result = []
+    for entry in os.scandir(TEMP_DIR):
+        if not entry.is_dir() or entry.name.startswith("."):
+            continue
+        try:
+            accessed = entry.stat().st_mtime
+        except OSError:
+            continue
+        result.append({
+            "id": entry.name,
+            "bytes": _dir_size(entry.path),
+            "accessed": accessed,
+            "pinned": os.path.exists(os.path.join(entry.path, PIN_MARKER)),
+        })
+    return result
+
+
+def _remove(path: str) -> int:
+    size = _dir_size(path)
+    shutil.rmtree(path, ignore_errors=True)
+    return size
+
+
+def collect(now: Optional[float] = None) -> dict:
+    """Run one clean-up pass and return what it removed."""
+    now = time.time() if now is None else now
+    removed = {"ttl": [], "quota": [], "scratch": 0, "freedBytes": 0, "ocrCache": 0, "jobs": 0, "pageSessions": 0}
+    with _lock:
+        if os.path.isdir(SCRATCH_DIR):
+            for entry in os.scandir(SCRATCH_DIR):
+                try:
+                    if now - entry.stat().st_mtime < SCRATCH_TTL_SECONDS:
+                        continue
+                    if entry.is_dir():
+                        removed["freedBytes"] += _remove(entry.path)
+                    else:
+                        removed["freedBytes"] += entry.stat().st_size
+                        os.remove(entry.path)
+                    removed["scratch"] += 1
+                except OSError:
+                    pass
+
+        live = []
+        for batch in batches():
+            if not batch["pinned"] and now - batch["accessed"] > TTL_SECONDS:
+                removed["freedBytes"] += _remove(os.path.join(TEMP_DIR, batch["id"]))
+                removed["ttl"].append(batch["id"])
+            else:
+                live.append(batch)
+
+        # Over quota: evict least recently accessed first
+        total = sum(b["bytes"] for b in live)
+        for batch in sorted(live, key=lambda b: b["accessed"]):
+            if total <= QUOTA_BYTES:
+                break
+            if batch["pinned"] or now - batch["accessed"] < MIN_AGE_SECONDS:
+                continue
+            removed["freedBytes"] += _remove(os.path.join(TEMP_DIR, batch["id"]))
+            removed["quota"].append(batch["id"])
+            total -= batch["bytes"]
+
+        for batch_id in removed["ttl"] + removed["quota"]:
+            _last_touch.pop(batch_id, None)
+        _stats["lastRun"] = now
+        _stats["evictedTtl"] += len(removed["ttl"])
+        _stats["evictedQuota"] += len(removed["quota"])
+        _stats["scratchRemoved"] += removed["scratch"]
+        _stats["freedBytes"] += removed["freedBytes"]
+    removed["ocrCache"] = ocr_cache.prune()
+    removed["jobs"] = jobs.collect()
+    removed["pageSessions"] = page_cache.collect()
+    if removed["ttl"] or removed["quota"] or removed["scratch"]:
+        print(f"[GC] Removed {len(removed['ttl'])} expired, {len(removed['quota'])} over-quota batches, "
+              f"{removed['scratch']} scratch entries ({removed['freedBytes'] // 1024} KiB)")
+    return removed
+
+
+def usage() -> dict:
+    current = batches()
+    return {
+        "batches": len(current),
+        "pinned": sum(1 for b in current if b["pinned"]),
+        "bytes": sum(b["bytes"] for b in current),
+        "scratchBytes": _dir_size(SCRATCH_DIR) if os.path.isdir(SCRATCH_DIR) else 0,
+        "quotaBytes": QUOTA_BYTES,
+        "ttlSeconds": TTL_SECONDS,
+        "oldestAccess": min((b["accessed"] for b in current), default=None),
+        **_stats,
+    }
+
+
+def _run():
+    while not _stop.wait(INTERVAL_SECONDS):
+        try:
+            collect()
+        except Exception as e:
+            print(f"[GC] Clean-up failed: {e}")
+
+
+def start():
+    """Start the periodic clean-up thread (idempotent)."""
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_run, name="temp-janitor", daemon=True)
+    _thread.start()
+
+
+def stop():
+    _stop.set()
@@ -0,0 +1,235 @@
+import json
+import os
+import shutil
+import socket
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional
+
+import storage
+
+# Long-running work (batch OCR, exports) runs as background jobs instead of
+# inside one HTTP request. Each job lives in data/jobs/<id>/:
+#   job.json       state and progress, rewritten on every change
+#   results.ndjson incremental results, one JSON object per line
+#   <artifact>     final output file, if the job produces one
+#   cancel         marker asking the process that runs the job to stop
+# Finished jobs (and their artifacts, e.g. exports with embedded scans) are
+# removed TTL hours after they ended, or earlier through delete().
+# With several uvicorn workers a job runs in the process that accepted it;
+# the others read its job.json. A job whose owning process is gone is
+# reported as interrupted.
+JOB_DIR = "data/jobs"
+WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+TTL = timedelta(hours=float(os.environ.get("JOB_TTL_HOURS", 24)))
+os.makedirs(JOB_DIR, exist_ok=True)
+
+FINISHED = ("done", "failed", "cancelled", "interrupted")
+OWNER = {"host": socket.gethostname(), "pid": os.getpid()}
+
+_lock = threading.Lock()
+_jobs = {}  # jobs running (or queued) in this process
+_executor = ThreadPoolExecutor(max_workers=WORKERS)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, state: dict):
+        self.state = state
+        self._cancel = threading.Event()
+        self._results_lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+    @property
+    def id(self) -> str:
+        return self.state["id"]
+
+    @property
+    def dir(self) -> str:
+        return os.path.join(JOB_DIR, self.id)
+
+    @property
+    def results_path(self) -> str:
+        return os.path.join(self.dir, "results.ndjson")
+
+    @property
+    def cancel_path(self) -> str:
+        return os.path.join(self.dir, "cancel")
+
+    def save(self):
+        # cancel() and the worker thread may save at the same time
+        with self._save_lock:
+            self.state["updated"] = datetime.utcnow().isoformat()
+            storage.write_json(os.path.join(self.dir, "job.json"), self.state, indent=2, ensure_ascii=False)
+
+    # Called from the job function
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+    @property
+    def cancelled(self) -> bool:
+        if not self._cancel.is_set() and os.path.exists(self.cancel_path):
+            self._cancel.set()  # cancelled through another worker
+        return self._cancel.is_set()
+
+    def set_total(self, total: int):
+        self.state["total"] = total
+        self.save()
+
+    def advance(self, result: dict = None):
+        """Record one finished unit of work and its (optional) result."""
+        with self._results_lock:
+            if result is not None:
+                with open(self.results_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(result, ensure_ascii=False) + "\n")
+            self.state["done"] += 1
+            self.save()
+
+    def set_artifact(self, filename: str, media_type: str) -> str:
+        """Register the final output file; returns the path to write it to."""
+        self.state["artifact"] = {"filename": filename, "media_type": media_type}
+        return os.path.join(self.dir, filename)
+
+    # Called from the API
+
+    def cancel(self):
+        open(self.cancel_path, "a").close()
+        self._cancel.set()
+        # Only the owning process writes job.json while the job is active
+        if self.state["status"] == "queued" and self.state.get("owner") == OWNER:
+            self.state["status"] = "cancelled"
+            self.save()
+
+    def artifact_path(self):
+        artifact = self.state.get("artifact")
+        if not artifact or self.state["status"] != "done":
+            return None
+        return os.path.join(self.dir, artifact["filename"])
+
+
+def _run(job: Job, fn):
+    if job.cancelled:
+        if job.state["status"] != "cancelled":
+            job.state["status"] = "cancelled"
+            job.save()
+        return
+    job.state["status"] = "running"
+    job.save()
+    try:
+        fn(job)
+        job.state["status"] = "done"
+    except JobCancelled:
+        job.state["status"] = "cancelled"
+    except Exception as e:
+        print(f"[JOB] {job.id} failed: {e}")
+        job.state["status"] = "failed"
+        job.state["error"] = str(e)
+    job.save()
+
+
+def submit(kind: str, fn, total: int = 0, params: dict = None) -> Job:
+    """Queue fn(job) for background execution and return the job."""
+    now = datetime.utcnow().isoformat()
+    job = Job({
+        "id": str(uuid.uuid4()),
+        "kind": kind,
+        "status": "queued",
+        "params": params or {},
+        "total": total,
+        "done": 0,
+        "created": now,
+        "updated": now,
+        "error": None,
+        "artifact": None,
+        "owner": OWNER,
+    })
+    os.makedirs(job.dir, exist_ok=True)
+    job.save()
+    with _lock:
+        _jobs[job.id] = job
+    _executor.submit(_run, job, fn)
+    return job
+
+
+def _owner_alive(owner: Optional[dict]) -> bool:
+    """Whether the process that runs a job still exists; jobs of other hosts are assumed alive."""
+    if not owner:
+        return False  # written before jobs recorded their owner
+    if owner.get("host") != OWNER["host"]:
+        return True
+    if owner.get("pid") == OWNER["pid"]:
+        return False  # an earlier server process that had the same pid
+    try:
+        os.kill(owner["pid"], 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OverflowError, TypeError):
+        pass
+    return True
+
+
+def get(job_id: str) -> Optional[Job]:
+    """The job from this process, or as last saved by the worker that runs it."""
+    with _lock:
+        job = _jobs.get(job_id)
+    if job is not None:
+        return job
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        return None
+    try:
+        job = Job(storage.read_json(os.path.join(JOB_DIR, job_id, "job.json")))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"[JOB] Skipping {job_id}: {e}")
+        return None
+    if job.state["status"] not in FINISHED and not _owner_alive(job.state.get("owner")):
+        job.state["status"] = "interrupted"
+        job.save()
+    return job
+
+
+def list_jobs():
+    found = (get(job_id) for job_id in os.listdir(JOB_DIR))
+    return [job.state for job in found if job is not None]
+
+
+def delete(job_id: str) -> Optional[bool]:
+    """Remove a finished job and its files; None if unknown, False if still running."""
+    job = get(job_id)
+    if job is None:
+        return None
+    if job.state["status"] not in FINISHED:
+        return False
+    with _lock:
+        _jobs.pop(job_id, None)
+    shutil.rmtree(job.dir, ignore_errors=True)
+    return True
+
+
+def collect(now: Optional[datetime] = None) -> int:
+    """Remove finished jobs that ended more than TTL ago; returns how many."""
+    cutoff = ((now or datetime.utcnow()) - TTL).isoformat()
+    expired = [state["id"] for state in list_jobs()
+               if state["status"] in FINISHED and state["updated"] < cutoff]
+    return sum(1 for job_id in expired if delete(job_id))
+
+
+def iter_results(job: Job, offset: int = 0):
+    """Yield result lines already written, starting at line `offset`."""
+    if not os.path.exists(job.results_path):
+        return
+    with open(job.results_path, "r", encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            if i >= offset and line.endswith("\n"):
+                yield line
+
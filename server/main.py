@@ -1,9 +1,20 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from routers import ocr, profiles, process_zip, invoice_queue, export_template, overview, backup, converters, bank
+from routers import ocr, profiles, process_zip, invoice_queue, export_template, overview, backup, converters, bank, jobs
+import janitor
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Periodic clean-up of temp_batches and converter scratch folders
+    janitor.start()
+    yield
+    janitor.stop()
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Enable CORS for development
 app.add_middleware(
@@ -12,7 +23,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["Content-Disposition"],
+    expose_headers=["Content-Disposition", "X-Total-Count", "X-Next-Cursor"],
 )
 
 # Register routers
@@ -25,3 +36,4 @@ app.include_router(overview.router)
 app.include_router(backup.router)
 app.include_router(converters.router)
 app.include_router(bank.router)
+app.include_router(jobs.router)
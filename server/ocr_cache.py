@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import storage
+
+# OCR results keyed by (image content hash, crop box, lang, config). The hash
+# gets a "-<preset>" suffix when the page was preprocessed before OCR.
+# Memory is a bounded LRU; every entry is also written to disk so results
+# survive a restart. The disk tier keeps one folder per image; once it
+# exceeds DISK_BYTES the least recently used image folders are pruned.
+CACHE_DIR = "data/ocr_cache"
+MEMORY_SIZE = int(os.environ.get("OCR_CACHE_SIZE", 4096))
+DISK_BYTES = int(os.environ.get("OCR_DISK_CACHE_MB", 512)) * 1024 * 1024
+# Writing this much since the last pass triggers another prune
+PRUNE_AFTER_BYTES = max(DISK_BYTES // 20, 1)
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+_lock = threading.Lock()
+_prune_lock = threading.Lock()
+_memory = OrderedDict()
+_stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "pruned": 0}
+_written = {"bytes": PRUNE_AFTER_BYTES}  # prune on the first write after start-up
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_key(image_hash: str, crop_box, lang: str, config: str):
+    return (image_hash, tuple(crop_box) if crop_box else None, lang, config)
+
+
+def _disk_path(key) -> str:
+    digest = hashlib.sha256(json.dumps(key[1:]).encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, key[0], f"{digest}.json")
+
+
+def _remember(key, value):
+    _memory[key] = value
+    _memory.move_to_end(key)
+    while len(_memory) > MEMORY_SIZE:
+        _memory.popitem(last=False)
+
+
+def get(key):
+    """Return the cached value for key, or None."""
+    with _lock:
+        if key in _memory:
+            _memory.move_to_end(key)
+            _stats["memory_hits"] += 1
+            return _memory[key]
+
+    path = _disk_path(key)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            value = json.load(f)
+    except (OSError, ValueError):
+        with _lock:
+            _stats["misses"] += 1
+        return None
+
+    try:
+        os.utime(os.path.dirname(path))  # folder mtime is the LRU clock
+    except OSError:
+        pass
+    with _lock:
+        _stats["disk_hits"] += 1
+        _remember(key, value)
+    return value
+
+
+def put(key, value):
+    with _lock:
+        _remember(key, value)
+    path = _disk_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    storage.write_json(path, value, fsync=False, ensure_ascii=False)
+
+    with _lock:
+        _written["bytes"] += os.path.getsize(path)
+        due = _written["bytes"] >= PRUNE_AFTER_BYTES
+        if due:
+            _written["bytes"] = 0
+    if due:
+        prune()
+
+
+def get_or_compute(key, compute):
+    value = get(key)
+    if value is None:
+        value = compute()
+        put(key, value)
+    return value
+
+
+def invalidate(image_hash: str = None) -> int:
+    """Drop cached results for one image (all its preprocessing variants), or everything."""
+    def matches(source):
+        return source == image_hash or source.startswith(f"{image_hash}-")
+
+    with _lock:
+        if image_hash is None:
+            removed = len(_memory)
+            _memory.clear()
+        else:
+            keys = [k for k in _memory if matches(k[0])]
+            for k in keys:
+                del _memory[k]
+            removed = len(keys)
+
+    if image_hash is None:
+        shutil.rmtree(CACHE_DIR, ignore_errors=True)
+        os.makedirs(CACHE_DIR, exist_ok=True)
+    else:
+        for name in os.listdir(CACHE_DIR):
+            if matches(name):
+                shutil.rmtree(os.path.join(CACHE_DIR, name), ignore_errors=True)
+    return removed
+
+
+def _folder_size(path: str) -> int:
+    total = 0
+    for entry in os.scandir(path):
+        try:
+            total += entry.stat().st_size
+        except OSError:
+            pass
+    return total
+
+
+def prune(max_bytes: int = None) -> int:
+    """Remove least recently used image folders until the disk tier fits max_bytes."""
+    max_bytes = DISK_BYTES if max_bytes is None else max_bytes
+    if not _prune_lock.acquire(blocking=False):
+        return 0  # another thread is already pruning
+    try:
+        folders = []
+        for entry in os.scandir(CACHE_DIR):
+            if entry.is_dir():
+                try:
+                    folders.append((entry.stat().st_mtime, _folder_size(entry.path), entry.path))
+                except OSError:
+                    continue
+        total = sum(size for _, size, _ in folders)
+        removed = 0
+        for _, size, path in sorted(folders):
+            if total <= max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+    finally:
+        _prune_lock.release()
+    if removed:
+        with _lock:
+            _stats["pruned"] += removed
+        print(f"[OCR] Pruned {removed} images from the disk cache")
+    return removed
+
+
+def stats():
+    with _lock:
+        result = dict(_stats)
+        result["memory_entries"] = len(_memory)
+        result["memory_size"] = MEMORY_SIZE
+        result["disk_budget"] = DISK_BYTES
+    lookups = result["memory_hits"] + result["disk_hits"] + result["misses"]
+    result["hit_rate"] = round((result["memory_hits"] + result["disk_hits"]) / lookups, 4) if lookups else 0.0
+    return result
@@ -0,0 +1,268 @@
+import os
+import queue
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import pytesseract
+
+# tesserocr binds the Tesseract C API directly, so a loaded model can stay in
+# memory between calls. It is optional: without it we use the pytesseract CLI.
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+# "pool" keeps warm in-process engines, "subprocess" always forks `tesseract`
+OCR_ENGINE = os.environ.get("OCR_ENGINE", "pool")
+POOL_SIZE = int(os.environ.get("OCR_POOL_SIZE", os.cpu_count() or 1))
+MAX_POOL_KEYS = int(os.environ.get("OCR_POOL_KEYS", 8))
+# Seconds before a `tesseract` subprocess is killed, 0 disables the limit
+CALL_TIMEOUT = float(os.environ.get("OCR_CALL_TIMEOUT", 30))
+
+
+def build_config(psm: Optional[int] = None, whitelist: Optional[str] = None) -> str:
+    """Build a tesseract CLI config string for the subprocess path."""
+    parts = []
+    if psm is not None:
+        parts.append(f"--psm {psm}")
+    if whitelist:
+        parts.append(f"-c tessedit_char_whitelist={whitelist}")
+    return " ".join(parts)
+
+
+class EnginePool:
+    """Bounded set of warm tesserocr engines, keyed by (lang, psm, whitelist).
+
+    Each key holds at most `size` engines (one per worker core). Engines are
+    created lazily and handed back after every call, so the traineddata is
+    loaded once per engine instead of once per zone. When more than
+    `max_keys` configurations are in use, the least recently used one is shut
+    down.
+    """
+
+    def __init__(self, size: int = POOL_SIZE, max_keys: int = MAX_POOL_KEYS):
+        self.size = max(1, size)
+        self.max_keys = max(1, max_keys)
+        self._lock = threading.Lock()
+        self._pools = OrderedDict()  # key -> [idle queue, created count]
+
+    def _slot(self, key):
+        with self._lock:
+            if key in self._pools:
+                self._pools.move_to_end(key)
+            else:
+                self._pools[key] = [queue.LifoQueue(), 0]
+                while len(self._pools) > self.max_keys:
+                    _, (idle, _) = self._pools.popitem(last=False)
+                    self._drain(idle)
+            return self._pools[key]
+
+    @staticmethod
+    def _drain(idle):
+        while True:
+            try:
+                idle.get_nowait().End()
+            except queue.Empty:
+                return
+
+    def _create(self, key):
+        lang, psm, whitelist = key
+        kwargs = {"lang": lang}
+        if psm is not None:
+            kwargs["psm"] = psm
+        api = tesserocr.PyTessBaseAPI(**kwargs)
+        if whitelist:
+            api.SetVariable("tessedit_char_whitelist", whitelist)
+        return api
+
+    def acquire(self, key):
+        slot = self._slot(key)
+        idle = slot[0]
+        try:
+            return slot, idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if slot[1] < self.size:
+                slot[1] += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return slot, self._create(key)
+            except Exception:
+                with self._lock:
+                    slot[1] -= 1
+                raise
+        while True:
+            try:
+                return slot, idle.get(timeout=1.0)
+            except queue.Empty:
+                with self._lock:
+                    evicted = self._pools.get(key) is not slot
+                if evicted:
+                    return self.acquire(key)
+
+    def release(self, key, slot, api):
+        with self._lock:
+            current = self._pools.get(key)
+        if current is not slot:
+            # configuration was evicted while this engine was busy
+            api.End()
+        else:
+            slot[0].put(api)
+
+    def close(self):
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for idle, _ in pools:
+            self._drain(idle)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "configs": [
+                    {"lang": k[0], "psm": k[1], "whitelist": k[2], "engines": v[1], "idle": v[0].qsize()}
+                    for k, v in self._pools.items()
+                ],
+            }
+
+
+_pool = EnginePool() if tesserocr is not None else None
+
+
+def pool_enabled() -> bool:
+    return _pool is not None and OCR_ENGINE == "pool"
+
+
+def image_to_data(image, lang: str = "eng", psm: Optional[int] = None, whitelist: Optional[str] = None) -> List[dict]:
+    """Run layout analysis and recognition once, returning word boxes.
+
+    Each word is a dict with text, left, top, width, height, conf (0-100) and
+    line, a tuple identifying the text line the word belongs to.
+    """
+    if not pool_enabled():
+        data = pytesseract.image_to_data(
+            image, lang=lang, config=build_config(psm, whitelist), output_type=pytesseract.Output.DICT,
+            timeout=CALL_TIMEOUT
+        )
+        return _tsv_words(data)
+
+    key = (lang, psm, whitelist or None)
+    slot, api = _pool.acquire(key)
+    try:
+        api.SetImage(image)
+        api.Recognize()
+        return _api_words(api)
+    finally:
+        api.Clear()
+        _pool.release(key, slot, api)
+
+
+def _tsv_words(data: dict) -> List[dict]:
+    words = []
+    for i, text in enumerate(data["text"]):
+        text = text.strip()
+        if not text:
+            continue
+        words.append({
+            "text": text,
+            "left": data["left"][i],
+            "top": data["top"][i],
+            "width": data["width"][i],
+            "height": data["height"][i],
+            "conf": float(data["conf"][i]),
+            "line": (data["block_num"][i], data["par_num"][i], data["line_num"][i]),
+        })
+    return words
+
+
+def _api_words(api) -> List[dict]:
+    """Word boxes of the last Recognize() call of a pooled engine."""
+    words = []
+    line = 0
+    it = api.GetIterator()
+    level = tesserocr.RIL.WORD
+    for w in tesserocr.iterate_level(it, level):
+        if w.IsAtBeginningOf(tesserocr.RIL.TEXTLINE):
+            line += 1
+        text = (w.GetUTF8Text(level) or "").strip()
+        box = w.BoundingBox(level)
+        if not text or box is None:
+            continue
+        x1, y1, x2, y2 = box
+        words.append({
+            "text": text,
+            "left": x1,
+            "top": y1,
+            "width": x2 - x1,
+            "height": y2 - y1,
+            "conf": float(w.Confidence(level)),
+            "line": (line,),
+        })
+    return words
+
+
+def _cli_text_and_words(image, lang: str, psm: Optional[int], whitelist: Optional[str]):
+    """One `tesseract` run writing both the plain text (as image_to_string) and the TSV word boxes."""
+    # save, run_tesseract and file_to_dict are pytesseract internals, checked
+    # against pytesseract==0.3.13 (pinned in requirements.txt); the public API
+    # runs tesseract once per output type
+    cli = pytesseract.pytesseract
+    config = f"{build_config(psm, whitelist)} -c tessedit_create_tsv=1".strip()
+    with cli.save(image) as (output_base, input_filename):
+        cli.run_tesseract(input_filename, output_base, "txt tsv", lang, config, timeout=CALL_TIMEOUT)
+        with open(f"{output_base}.txt", "r", encoding="utf-8") as f:
+            text = f.read()
+        with open(f"{output_base}.tsv", "r", encoding="utf-8") as f:
+            data = cli.file_to_dict(f.read(), "\t", -1)
+    return text, _tsv_words(data)
+
+
+def words_to_text(words: List[dict]) -> str:
+    """Join word boxes into text, one output line per recognised text line."""
+    lines = {}
+    for word in words:
+        lines.setdefault(tuple(word["line"]), []).append(word)
+    ordered = sorted(lines.values(), key=lambda ws: min(w["top"] for w in ws))
+    return "\n".join(" ".join(w["text"] for w in sorted(ws, key=lambda w: w["left"])) for ws in ordered)
+
+
+def mean_confidence(words: List[dict]) -> float:
+    """Character-weighted mean word confidence (0-100), 0 when nothing was read."""
+    chars = sum(len(w["text"]) for w in words)
+    if not chars:
+        return 0.0
+    return sum(w["conf"] * len(w["text"]) for w in words) / chars
+
+
+def recognize(image, lang: str = "eng", psm: Optional[int] = None, whitelist: Optional[str] = None):
+    """Recognise a PIL image and return (text, confidence).
+
+    Both engines return the text laid out as image_to_string does and the
+    character-weighted mean_confidence() of the recognised words.
+    """
+    if not pool_enabled():
+        text, words = _cli_text_and_words(image, lang, psm, whitelist)
+        return text, mean_confidence(words)
+
+    key = (lang, psm, whitelist or None)
+    slot, api = _pool.acquire(key)
+    try:
+        api.SetImage(image)
+        api.Recognize()
+        return api.GetUTF8Text(), mean_confidence(_api_words(api))
+    finally:
+        api.Clear()
+        _pool.release(key, slot, api)
+
+
+def engine_stats():
+    return {
+        "engine": "pool" if pool_enabled() else "subprocess",
+        "pool": _pool.stats() if _pool is not None else None,
+    }
@@ -0,0 +1,257 @@
+import base64
+import json
+import os
+import sqlite3
+import sys
+from contextlib import contextmanager
+from typing import Optional
+
+import storage
+
+# Overview invoices in SQLite instead of one JSON file per invoice. The
+# invoice is stored as sent (the "data" column), so payloads are unchanged;
+# the columns next to it are copies of the fields the overview filters and
+# sorts on, each with an index. "version" grows on every write and is the
+# invoice's ETag. JSON files found in the old data/overview folder are
+# imported on startup and moved to MIGRATED_DIR.
+DB_PATH = "data/overview.db"
+OVERVIEW_DIR = "data/overview"
+MIGRATED_DIR = "data/overview_migrated"
+
+# Sortable fields and their columns; each has a (column, id) index so a page
+# after a cursor is an index range scan
+SORT_COLUMNS = {
+    "order": "sort_order",
+    "invoice_date": "invoice_date",
+    "batch_name": "batch_name",
+    "company_id": "company_id",
+}
+
+
+@contextmanager
+def _connect():
+    """A connection that commits on success and is always closed."""
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def _init():
+    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    with _connect() as conn:
+        conn.executescript("""
+            -- Text columns hold '' rather than NULL so cursors can compare them
+            CREATE TABLE IF NOT EXISTS invoices (
+                id TEXT PRIMARY KEY,
+                batch_name TEXT NOT NULL DEFAULT '',
+                invoice_date TEXT NOT NULL DEFAULT '',
+                company_id TEXT NOT NULL DEFAULT '',
+                template_used TEXT,
+                selected INTEGER,
+                sort_order INTEGER,
+                version INTEGER NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS invoices_batch_name_id ON invoices (batch_name, id);
+            CREATE INDEX IF NOT EXISTS invoices_invoice_date_id ON invoices (invoice_date, id);
+            CREATE INDEX IF NOT EXISTS invoices_company_id_id ON invoices (company_id, id);
+            CREATE INDEX IF NOT EXISTS invoices_sort_order_id ON invoices (sort_order, id);
+            CREATE INDEX IF NOT EXISTS invoices_batch_sort_order ON invoices (batch_name, sort_order, id);
+            CREATE INDEX IF NOT EXISTS invoices_template_used ON invoices (template_used);
+        """)
+    migrate()
+
+
+def etag(version: Optional[int]) -> Optional[str]:
+    return None if version is None else f'"{version}"'
+
+
+def _int(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _row(uid: str, invoice: dict, version: int) -> tuple:
+    return (uid, invoice.get("batch_name") or "", invoice.get("invoice_date") or "",
+            invoice.get("company_id") or "", invoice.get("template_used"), int(bool(invoice.get("selected", True))),
+            _int(invoice.get("order")), version, json.dumps(invoice, ensure_ascii=False))
+
+
+def _version(conn, uid: str) -> Optional[int]:
+    row = conn.execute("SELECT version FROM invoices WHERE id = ?", (uid,)).fetchone()
+    return row["version"] if row else None
+
+
+def get(uid: str):
+    """Return (invoice, version), or (None, None) when there is no such invoice."""
+    with _connect() as conn:
+        row = conn.execute("SELECT data, version FROM invoices WHERE id = ?", (uid,)).fetchone()
+    if row is None:
+        return None, None
+    return json.loads(row["data"]), row["version"]
+
+
+def put(invoice: dict, if_match: Optional[str] = None, uid: Optional[str] = None) -> int:
+    """Insert or replace an invoice; returns its new version. A stale if_match gives 412."""
+    uid = uid or invoice["id"]
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        current = _version(conn, uid)
+        storage.check_etag(etag(current), if_match)
+        version = (current or 0) + 1
+        conn.execute("INSERT OR REPLACE INTO invoices VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     _row(uid, invoice, version))
+    return version
+
+
+def put_many(invoices: list):
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for invoice in invoices:
+            version = (_version(conn, invoice["id"]) or 0) + 1
+            conn.execute("INSERT OR REPLACE INTO invoices VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         _row(invoice["id"], invoice, version))
+
+
+def update(uid: str, fields: dict, if_match: Optional[str] = None) -> Optional[int]:
+    """Merge fields into a stored invoice; returns the new version, None if it does not exist."""
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT data, version FROM invoices WHERE id = ?", (uid,)).fetchone()
+        if row is None:
+            return None
+        storage.check_etag(etag(row["version"]), if_match)
+        invoice = json.loads(row["data"])
+        invoice.update(fields)
+        version = row["version"] + 1
+        conn.execute("INSERT OR REPLACE INTO invoices VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     _row(uid, invoice, version))
+    return version
+
+
+def delete(uid: str, if_match: Optional[str] = None) -> bool:
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        current = _version(conn, uid)
+        if current is None:
+            return False
+        storage.check_etag(etag(current), if_match)
+        conn.execute("DELETE FROM invoices WHERE id = ?", (uid,))
+    return True
+
+
+def clear() -> int:
+    with _connect() as conn:
+        return conn.execute("DELETE FROM invoices").rowcount
+
+
+def _encode_cursor(sort: str, value, uid: str) -> str:
+    raw = json.dumps([sort, value, uid], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def _decode_cursor(cursor: str, sort: str):
+    try:
+        cursor_sort, value, uid = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if cursor_sort != sort:
+        raise ValueError("Cursor belongs to a different sort")
+    return value, uid
+
+
+def query(batch: Optional[str] = None, date_from: Optional[str] = None, date_to: Optional[str] = None,
+          template: Optional[str] = None, company: Optional[str] = None, selected: Optional[bool] = None,
+          sort: str = "order", descending: bool = False, limit: Optional[int] = None,
+          cursor: Optional[str] = None):
+    """Return (invoices, total matching the filters, cursor of the next page or None).
+
+    Dates are compared as ISO strings (YYYY-MM-DD), both ends inclusive.
+    Invoices without a numeric order are not listed.
+    """
+    if sort not in SORT_COLUMNS:
+        raise ValueError(f"Cannot sort by '{sort}'")
+    column = SORT_COLUMNS[sort]
+    where, params = ["sort_order IS NOT NULL"], []
+    for condition, value in (("batch_name = ?", batch), ("invoice_date >= ?", date_from),
+                             ("invoice_date <= ?", date_to), ("template_used = ?", template),
+                             ("company_id = ?", company)):
+        if value is not None:
+            where.append(condition)
+            params.append(value)
+    if selected is not None:
+        where.append("selected = ?")
+        params.append(int(selected))
+
+    page_where, page_params = list(where), list(params)
+    if cursor:
+        value, uid = _decode_cursor(cursor, sort)
+        op = "<" if descending else ">"
+        page_where.append(f"({column} {op} ? OR ({column} = ? AND id {op} ?))")
+        page_params += [value, value, uid]
+
+    direction = "DESC" if descending else "ASC"
+    sql = (f"SELECT id, {column} AS sort_value, data FROM invoices WHERE {' AND '.join(page_where)} "
+           f"ORDER BY {column} {direction}, id {direction}")
+    if limit is not None:
+        sql += " LIMIT ?"
+        page_params.append(limit + 1)
+
+    with _connect() as conn:
+        total = conn.execute(f"SELECT COUNT(*) FROM invoices WHERE {' AND '.join(where)}", params).fetchone()[0]
+        rows = conn.execute(sql, page_params).fetchall()
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(sort, rows[-1]["sort_value"], rows[-1]["id"])
+    return [json.loads(row["data"]) for row in rows], total, next_cursor
+
+
+def migrate() -> int:
+    """Import the JSON files left in OVERVIEW_DIR; the database wins for ids it already has."""
+    if not os.path.isdir(OVERVIEW_DIR):
+        return 0
+    imported = []
+    rows = []
+    for filename in sorted(os.listdir(OVERVIEW_DIR)):
+        if not filename.endswith(".json"):
+            continue
+        path = os.path.join(OVERVIEW_DIR, filename)
+        try:
+            invoice = storage.read_json(path)
+            rows.append(_row(filename[:-len(".json")], invoice, 1))
+            imported.append(path)
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"[OVERVIEW] Skipping {filename}: {e}")
+    if not rows:
+        return 0
+    with _connect() as conn:
+        conn.executemany("INSERT OR IGNORE INTO invoices VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    os.makedirs(MIGRATED_DIR, exist_ok=True)
+    for path in imported:
+        try:
+            os.replace(path, os.path.join(MIGRATED_DIR, os.path.basename(path)))
+        except FileNotFoundError:
+            pass  # moved by another worker migrating at the same time
+    print(f"[OVERVIEW] Imported {len(rows)} invoices from {OVERVIEW_DIR}")
+    return len(rows)
+
+
+_init()
+
+
+if __name__ == "__main__":
+    # python overview_store.py migrate
+    if sys.argv[1:] != ["migrate"]:
+        sys.exit("usage: python overview_store.py migrate")
+    print(f"Imported {migrate()} invoices")
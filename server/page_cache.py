@@ -0,0 +1,172 @@
+import io
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from PIL import Image
+
+import ocr_cache
+import storage
+
+# Decoded pages kept in memory so zone tests can refer to a page by id instead
+# of re-uploading and re-decoding it. Bounded by total decoded size and TTL.
+# The uploaded bytes are also kept in SESSION_DIR under the page id, so a
+# worker that did not receive the upload decodes the page from there; files
+# not used for TTL_SECONDS are removed by collect() (run by the janitor).
+SESSION_DIR = "data/page_sessions"
+MAX_BYTES = int(os.environ.get("PAGE_CACHE_MB", 512)) * 1024 * 1024
+TTL_SECONDS = int(os.environ.get("PAGE_CACHE_TTL", 1800))
+
+os.makedirs(SESSION_DIR, exist_ok=True)
+
+_PAGE_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+_lock = threading.Lock()
+_pages = OrderedDict()  # page_id -> {"variants": {name: Image}, "size": int, "accessed": float}
+
+
+def _image_size(image: Image.Image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+
+def _total_size() -> int:
+    return sum(entry["size"] for entry in _pages.values())
+
+
+def _evict(now: float):
+    expired = [pid for pid, entry in _pages.items() if now - entry["accessed"] > TTL_SECONDS]
+    for pid in expired:
+        del _pages[pid]
+    total = _total_size()
+    while total > MAX_BYTES and len(_pages) > 1:
+        _, entry = _pages.popitem(last=False)
+        total -= entry["size"]
+
+
+def _session_path(page_id: str) -> str:
+    return os.path.join(SESSION_DIR, page_id)
+
+
+def _touch(page_id: str) -> bool:
+    try:
+        os.utime(_session_path(page_id))
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _remember(page_id: str, image: Image.Image, now: float):
+    with _lock:
+        _pages[page_id] = {
+            "variants": {"original": image},
+            "size": _image_size(image),
+            "accessed": now,
+        }
+        _pages.move_to_end(page_id)
+        _evict(now)
+
+
+def put(image_bytes: bytes) -> str:
+    """Decode an uploaded page once and return its id (the content hash)."""
+    page_id = ocr_cache.content_hash(image_bytes)
+    now = time.time()
+    with _lock:
+        known = page_id in _pages
+        if known:
+            _pages[page_id]["accessed"] = now
+            _pages.move_to_end(page_id)
+    if not known:
+        image = Image.open(io.BytesIO(image_bytes))
+        image.load()
+        _remember(page_id, image, now)
+    if not _touch(page_id):
+        storage.write_bytes(_session_path(page_id), image_bytes, fsync=False)
+    return page_id
+
+
+def get(page_id: str):
+    """Return the decoded page, or None if it expired."""
+    now = time.time()
+    with _lock:
+        _evict(now)
+        entry = _pages.get(page_id)
+        if entry is not None:
+            entry["accessed"] = now
+            _pages.move_to_end(page_id)
+            image = entry["variants"]["original"]
+    if entry is not None:
+        _touch(page_id)
+        return image
+
+    # Uploaded to another worker, or evicted from memory here
+    if not _PAGE_ID_RE.match(page_id or ""):
+        return None
+    try:
+        with open(_session_path(page_id), "rb") as f:
+            image = Image.open(io.BytesIO(f.read()))
+            image.load()
+    except FileNotFoundError:
+        return None
+    _touch(page_id)
+    _remember(page_id, image, now)
+    return image
+
+
+def get_variant(page_id: str, name: str, build):
+    """Return a derived version of a page, building and caching it on first use; None if it expired."""
+    with _lock:
+        entry = _pages.get(page_id)
+        if entry is None:
+            return None
+        if name in entry["variants"]:
+            return entry["variants"][name]
+        original = entry["variants"]["original"]
+
+    image = build(original)
+
+    with _lock:
+        entry = _pages.get(page_id)
+        if entry is not None and name not in entry["variants"]:
+            entry["variants"][name] = image
+            entry["size"] += _image_size(image)
+            _evict(time.time())
+    return image
+
+
+def remove(page_id: str) -> bool:
+    with _lock:
+        removed = _pages.pop(page_id, None) is not None
+    if _PAGE_ID_RE.match(page_id or ""):
+        try:
+            os.remove(_session_path(page_id))
+            removed = True
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def collect(now: Optional[float] = None) -> int:
+    """Remove stored uploads not used for TTL_SECONDS; returns how many."""
+    cutoff = (now or time.time()) - TTL_SECONDS
+    removed = 0
+    for entry in os.scandir(SESSION_DIR):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            continue
+    return removed
+
+
+def stats():
+    with _lock:
+        _evict(time.time())
+        return {
+            "pages": len(_pages),
+            "bytes": _total_size(),
+            "max_bytes": MAX_BYTES,
+            "ttl_seconds": TTL_SECONDS,
+        }
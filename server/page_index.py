@@ -0,0 +1,344 @@
+import io
+import json
+import os
+import threading
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+import janitor
+import ocr_cache
+import queue_pages
+import storage
+
+# Index of every page seen in data/queues and temp_batches, used to spot
+# resent invoices. Each page is fingerprinted with its exact content hash and
+# a 256-bit difference hash (dHash) of a 17x16 grayscale thumbnail.
+#
+# Near-duplicate lookups use multi-index hashing: the dHash is split into
+# MAX_DISTANCE + 1 chunks and every chunk value is a bucket key. Two hashes
+# within MAX_DISTANCE bits must agree exactly on at least one chunk, so only
+# pages sharing a bucket are compared instead of the whole archive. Invoices
+# printed from one supplier template are that close too, so a near match is
+# only a candidate: it counts as a copy once OCR read the same values from
+# both pages (confirms()). Pages with almost no dHash bits set (blank or
+# near-uniform) only ever match by content hash.
+#
+# Records are appended to a JSONL file and replayed at start-up; the last
+# line for a content hash wins. Every uvicorn worker appends to the same file
+# (under its storage lock) and reads the lines added by the others before
+# each lookup; a rebuild or compaction replaces the file, which makes every
+# worker reload it. The file is compacted once it holds more than twice as
+# many lines as live records.
+INDEX_PATH = "data/page_index.jsonl"
+QUEUE_DIR = "data/queues"
+HASH_SIZE = 16
+HASH_BITS = HASH_SIZE * HASH_SIZE
+# A bit is set only when the right neighbour is brighter by more than this;
+# without the margin scanner noise flips the bits of blank paper areas
+MIN_GRADIENT = 8
+MAX_DISTANCE = int(os.environ.get("DUPLICATE_MAX_DISTANCE", 10))
+# Hashes with fewer set bits than this carry too little detail to compare
+MIN_DETAIL_BITS = 8
+# Do not compact small files, however many of their lines are superseded
+COMPACT_MIN_LINES = 1000
+
+_lock = threading.Lock()
+_records = {}  # content hash -> record
+_buckets = {}  # (chunk index, chunk value) -> set of content hashes
+_file = {"inode": None, "offset": 0, "lines": 0}  # how far INDEX_PATH has been replayed
+_CHUNK_BOUNDS = [
+    (HASH_BITS * i // (MAX_DISTANCE + 1), HASH_BITS * (i + 1) // (MAX_DISTANCE + 1))
+    for i in range(MAX_DISTANCE + 1)
+]
+
+
+def dhash(image: Image.Image) -> int:
+    """256-bit difference hash: is each thumbnail pixel darker than its right neighbour."""
+    if image.format == "JPEG":
+        image.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+    thumb = np.asarray(image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+    bits = np.packbits(thumb[:, 1:] > thumb[:, :-1] + MIN_GRADIENT)
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+def fingerprint(path: str):
+    """(content hash, dHash) of a page image file."""
+    with open(path, "rb") as f:
+        content = f.read()
+    with Image.open(path) as image:
+        return ocr_cache.content_hash(content), dhash(image)
+
+
+def _detailed(phash: int) -> bool:
+    return phash.bit_count() >= MIN_DETAIL_BITS
+
+
+def _chunks(phash: int):
+    for i, (start, end) in enumerate(_CHUNK_BOUNDS):
+        yield i, (phash >> (HASH_BITS - end)) & ((1 << (end - start)) - 1)
+
+
+def _discard(record: dict):
+    for key in _chunks(record["phash"]):
+        _buckets.get(key, set()).discard(record["sha"])
+
+
+def _add(record: dict):
+    previous = _records.get(record["sha"])
+    if previous is not None:
+        _discard(previous)
+    _records[record["sha"]] = record
+    if _detailed(record["phash"]):
+        for key in _chunks(record["phash"]):
+            _buckets.setdefault(key, set()).add(record["sha"])
+
+
+def _line(record: dict) -> bytes:
+    return (json.dumps({**record, "phash": format(record["phash"], "x")}, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def _append(record: dict):
+    os.makedirs(os.path.dirname(INDEX_PATH), exist_ok=True)
+    with storage.locked(INDEX_PATH, "index"):
+        with open(INDEX_PATH, "ab") as f:
+            f.write(_line(record))
+
+
+def _rewrite(records):
+    """Replace INDEX_PATH with one line per record and reload it. Caller holds _lock."""
+    os.makedirs(os.path.dirname(INDEX_PATH), exist_ok=True)
+    with storage.locked(INDEX_PATH, "index"):
+        storage.write_bytes(INDEX_PATH, b"".join(_line(record) for record in records))
+        _sync()
+
+
+def _sync():
+    """Replay lines appended since the last call, by this or another worker. Caller holds _lock."""
+    try:
+        f = open(INDEX_PATH, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        stat = os.fstat(f.fileno())
+        if stat.st_ino != _file["inode"] or stat.st_size < _file["offset"]:
+            # First load, or the file was rewritten (a freed inode number can be reused)
+            _records.clear()
+            _buckets.clear()
+            _file.update(inode=stat.st_ino, offset=0, lines=0)
+        f.seek(_file["offset"])
+        data = f.read()
+    end = data.rfind(b"\n") + 1  # a line still being written is read next time
+    _file["offset"] += end
+    for line in data[:end].splitlines():
+        _file["lines"] += 1
+        try:
+            record = json.loads(line)
+            record["phash"] = int(record["phash"], 16)
+        except (ValueError, KeyError):
+            continue
+        _add(record)
+
+
+def ref_path(ref: dict) -> str:
+    if ref["source"] == "queue":
+        return os.path.join(QUEUE_DIR, ref["name"], ref["filename"])
+    return os.path.join(janitor.TEMP_DIR, ref["batchId"], ref["filename"])
+
+
+def find(sha: str, phash: int) -> Optional[dict]:
+    """Closest indexed page within MAX_DISTANCE bits, with its distance; exact content matches win.
+
+    A near match is only a candidate, see confirms(). Pages whose file has
+    since been deleted are dropped from the index.
+    """
+    with _lock:
+        _sync()
+        if sha in _records:
+            candidates = [(0, _records[sha])]
+        elif not _detailed(phash):
+            candidates = []
+        else:
+            seen = set()
+            candidates = []
+            for key in _chunks(phash):
+                for other in _buckets.get(key, ()):
+                    if other in seen:
+                        continue
+                    seen.add(other)
+                    distance = (_records[other]["phash"] ^ phash).bit_count()
+                    if distance <= MAX_DISTANCE:
+                        candidates.append((distance, _records[other]))
+        candidates.sort(key=lambda c: c[0])
+
+    for distance, record in candidates:
+        if not os.path.exists(ref_path(record["ref"])):
+            with _lock:
+                if _records.get(record["sha"]) is record:
+                    _discard(record)
+                    del _records[record["sha"]]
+            continue
+        return {**record, "distance": distance}
+    return None
+
+
+def add(sha: str, phash: int, ref: dict, profile: Optional[str] = None,
+        values: Optional[dict] = None, verified: bool = False):
+    """Index a page; an existing record for the same content is only replaced by better values.
+
+    verified marks values a user has checked (saved in a queue); those are
+    never overwritten by fresh OCR output.
+    """
+    with _lock:
+        _sync()
+        previous = _records.get(sha)
+        if previous is not None:
+            if previous.get("verified") and not verified:
+                return
+            if values is None and previous.get("values") is not None:
+                return
+        record = {"sha": sha, "phash": phash, "ref": ref, "profile": profile,
+                  "values": values, "verified": verified}
+        _add(record)
+        _append(record)
+        due = _file["lines"] > COMPACT_MIN_LINES and _file["lines"] > 2 * len(_records)
+    if due:
+        compact()
+
+
+def add_file(path: str, ref: dict, profile: Optional[str] = None,
+             values: Optional[dict] = None, verified: bool = False, sha: Optional[str] = None):
+    """Index a page file; the image is only decoded when its content is new to the index.
+
+    Pass sha when the content hash is already known to skip reading the file
+    for pages the index has seen.
+    """
+    content = None
+    if sha is None:
+        with open(path, "rb") as f:
+            content = f.read()
+        sha = ocr_cache.content_hash(content)
+    with _lock:
+        _sync()
+        previous = _records.get(sha)
+    if previous is not None:
+        if (previous["ref"], previous.get("values"), previous.get("verified")) == (ref, values, verified):
+            return
+        phash = previous["phash"]
+    else:
+        with Image.open(io.BytesIO(content) if content is not None else path) as image:
+            phash = dhash(image)
+    add(sha, phash, ref, profile, values, verified)
+
+
+def describe(match: dict, sha: str) -> dict:
+    """The duplicateOf entry returned to clients; exact means identical file content."""
+    return {**match["ref"], "distance": match["distance"], "exact": match["sha"] == sha,
+            "verified": bool(match.get("verified"))}
+
+
+def _read_values(values: Optional[dict]) -> dict:
+    return {k: v.strip() for k, v in (values or {}).items()
+            if isinstance(v, str) and v.strip() and v.strip() != "NaN"}
+
+
+def confirms(match: dict, sha: str, profile: str, values: Optional[dict]) -> bool:
+    """Whether freshly OCRed values show that a near match is the same invoice.
+
+    Both pages must be read with the same profile and give identical values
+    for every field either of them has.
+    """
+    if match["sha"] == sha:
+        return True
+    if match.get("profile") != profile:
+        return False
+    read = _read_values(values)
+    return bool(read) and read == _read_values(match.get("values"))
+
+
+def reusable_values(match: dict, sha: str, profile: str) -> Optional[dict]:
+    """Values of an identical earlier page of the same profile.
+
+    Near duplicates are never reused: different invoices printed from one
+    supplier template are only a few dHash bits apart.
+    """
+    if match["sha"] != sha or match.get("values") is None or match.get("profile") != profile:
+        return None
+    return match["values"]
+
+
+def rebuild(queue_dir: str = QUEUE_DIR, temp_dir: str = janitor.TEMP_DIR) -> dict:
+    """Re-fingerprint every stored page and rewrite the index file."""
+    records = []
+    for name in sorted(os.listdir(queue_dir)) if os.path.isdir(queue_dir) else []:
+        queue_path = os.path.join(queue_dir, name)
+        try:
+            with open(os.path.join(queue_path, "meta.json"), "r", encoding="utf-8") as f:
+                profile = json.load(f).get("profile")
+            pages = queue_pages.read_pages(queue_path)
+        except (OSError, ValueError):
+            continue
+        for page in pages:
+            path = os.path.join(queue_path, page.get("filename", ""))
+            if os.path.isfile(path):
+                records.append((path, {"source": "queue", "name": name, "filename": page["filename"]},
+                                profile, page.get("values"), True))
+
+    for batch_id in sorted(os.listdir(temp_dir)) if os.path.isdir(temp_dir) else []:
+        batch_path = os.path.join(temp_dir, batch_id)
+        if batch_id.startswith(".") or not os.path.isdir(batch_path):
+            continue
+        try:
+            with open(os.path.join(batch_path, "batch.json"), "r", encoding="utf-8") as f:
+                profile = json.load(f).get("profile")
+        except (OSError, ValueError):
+            profile = None
+        for filename in sorted(os.listdir(batch_path)):
+            if filename.lower().endswith((".png", ".jpg", ".jpeg")):
+                records.append((os.path.join(batch_path, filename),
+                                {"source": "batch", "batchId": batch_id, "filename": filename},
+                                profile, None, False))
+
+    fresh = {}
+    for path, ref, profile, values, verified in records:
+        try:
+            sha, phash = fingerprint(path)
+        except Exception as e:
+            print(f"[INDEX] Cannot fingerprint {path}: {e}")
+            continue
+        # Queue pages come first, so checked values are kept over batch copies
+        if sha not in fresh:
+            fresh[sha] = {"sha": sha, "phash": phash, "ref": ref, "profile": profile,
+                          "values": values, "verified": verified}
+
+    with _lock:
+        _rewrite(fresh.values())
+    return stats()
+
+
+def compact() -> int:
+    """Rewrite the index file without superseded lines and pages whose file is gone; returns lines dropped."""
+    with _lock:
+        _sync()
+        before = _file["lines"]
+        _rewrite([r for r in _records.values() if os.path.exists(ref_path(r["ref"]))])
+        dropped = before - _file["lines"]
+    print(f"[INDEX] Compacted {INDEX_PATH}, dropped {dropped} lines")
+    return dropped
+
+
+def stats() -> dict:
+    with _lock:
+        _sync()
+        return {
+            "pages": len(_records),
+            "buckets": len(_buckets),
+            "withValues": sum(1 for r in _records.values() if r.get("values") is not None),
+            "lines": _file["lines"],
+            "maxDistance": MAX_DISTANCE,
+        }
+
+
+with _lock:
+    _sync()
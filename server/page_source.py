@@ -0,0 +1,104 @@
+import json
+import os
+import re
+
+from PIL import Image
+
+import storage
+
+# Multi-page containers (PDF, TIFF) are stored as uploaded and exposed as
+# virtual page files named "<container>__p0001.png". A page is rasterised the
+# first time it is viewed or OCR'd and the PNG is kept next to the container,
+# at the DPI recorded for the batch in batch.json.
+CONTAINER_EXTENSIONS = ('.pdf', '.tif', '.tiff')
+DEFAULT_DPI = 300
+BATCH_META = "batch.json"
+
+_VIRTUAL_RE = re.compile(r"^(?P<container>.+\.(?:pdf|tiff?))__p(?P<page>\d{4,})\.png$", re.IGNORECASE)
+
+
+def is_container(filename: str) -> bool:
+    return filename.lower().endswith(CONTAINER_EXTENSIONS)
+
+
+def virtual_name(container: str, index: int) -> str:
+    return f"{container}__p{index + 1:04d}.png"
+
+
+def parse_virtual(filename: str):
+    """Return (container filename, zero-based page index) for a virtual page name, else None."""
+    match = _VIRTUAL_RE.match(filename)
+    if not match:
+        return None
+    return match.group("container"), int(match.group("page")) - 1
+
+
+def page_count(path: str) -> int:
+    """Number of pages in a container, read from its header / page tree only."""
+    if path.lower().endswith(".pdf"):
+        from pdf2image import pdfinfo_from_path
+        return int(pdfinfo_from_path(path)["Pages"])
+    with Image.open(path) as image:
+        return getattr(image, "n_frames", 1)
+
+
+def container_pages(path: str):
+    filename = os.path.basename(path)
+    return [virtual_name(filename, i) for i in range(page_count(path))]
+
+
+def write_batch_meta(batch_dir: str, **meta):
+    storage.write_json(os.path.join(batch_dir, BATCH_META), meta)
+
+
+def batch_dpi(batch_dir: str) -> int:
+    try:
+        with open(os.path.join(batch_dir, BATCH_META), "r", encoding="utf-8") as f:
+            return int(json.load(f).get("dpi", DEFAULT_DPI))
+    except (OSError, ValueError):
+        return DEFAULT_DPI
+
+
+def _rasterise(container_path: str, index: int, dpi: int) -> Image.Image:
+    if container_path.lower().endswith(".pdf"):
+        from pdf2image import convert_from_path
+        return convert_from_path(container_path, dpi=dpi, first_page=index + 1, last_page=index + 1)[0]
+
+    with Image.open(container_path) as tiff:
+        tiff.seek(index)
+        page = tiff.convert("L" if tiff.mode in ("1", "L") else "RGB")
+        source_dpi = tiff.info.get("dpi", (0, 0))[0]
+    if source_dpi and abs(source_dpi - dpi) > 1:
+        scale = dpi / float(source_dpi)
+        page = page.resize((round(page.width * scale), round(page.height * scale)), Image.LANCZOS)
+    return page
+
+
+def ensure_page(path: str) -> bool:
+    """Make sure a page file exists on disk, rasterising virtual pages on first use.
+
+    Returns False when the path is neither an existing file nor a page of an
+    existing container.
+    """
+    if os.path.exists(path):
+        return True
+    parsed = parse_virtual(os.path.basename(path))
+    if parsed is None:
+        return False
+    batch_dir = os.path.dirname(path)
+    container_path = os.path.join(batch_dir, parsed[0])
+    if not os.path.exists(container_path):
+        return False
+
+    # One rasterisation per page, in any worker; a second request finds the file
+    with storage.locked(path, "pages"):
+        if os.path.exists(path):
+            return True
+        dpi = batch_dpi(batch_dir)
+        try:
+            page = _rasterise(container_path, parsed[1], dpi)
+        except (EOFError, IndexError):
+            return False
+        with storage.open_atomic(path, fsync=False) as f:
+            page.save(f, format="PNG", dpi=(dpi, dpi))
+    return True
@@ -0,0 +1,123 @@
+import time
+
+import numpy as np
+from PIL import Image
+
+# Page preprocessing before OCR. Every step works on whole NumPy arrays; the
+# pipeline runs once per page and all zones are cropped from its output.
+TARGET_DPI = 300
+# Resolutions outside this range are taken for bogus metadata (72 dpi is what
+# many tools write by default) and the page is left as it is
+MIN_DPI = 100
+MAX_DPI = 600
+MAX_UPSCALE = 2.0  # caps the pixel count at four times the original
+THRESHOLD_BLOCK = 31  # odd window size for the adaptive threshold
+THRESHOLD_OFFSET = 10
+DESKEW_MAX_ANGLE = 5.0
+DESKEW_STEP = 0.5
+DESKEW_WIDTH = 800  # skew is estimated on a downscaled copy
+
+PRESETS = {
+    "none": [],
+    "gray": ["gray"],
+    "clean": ["gray", "denoise", "threshold"],
+    "scan": ["dpi", "gray", "deskew", "denoise", "threshold"],
+}
+DEFAULT_PRESET = "none"
+
+
+def to_gray(arr: np.ndarray) -> np.ndarray:
+    if arr.ndim == 2:
+        return arr
+    rgb = arr[..., :3].astype(np.float32)
+    return (rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)).clip(0, 255).astype(np.uint8)
+
+
+def adaptive_threshold(gray: np.ndarray, block: int = THRESHOLD_BLOCK, offset: int = THRESHOLD_OFFSET) -> np.ndarray:
+    """Binarise against the local mean, computed with an integral image."""
+    r = block // 2
+    padded = np.pad(gray, r + 1, mode="edge")
+    integral = padded.cumsum(axis=0, dtype=np.int64).cumsum(axis=1)
+    h, w = gray.shape
+    sums = (integral[block:block + h, block:block + w] - integral[:h, block:block + w]
+            - integral[block:block + h, :w] + integral[:h, :w])
+    # gray > mean - offset, kept in integers by scaling with the window area
+    area = block * block
+    return np.where(gray.astype(np.int64) * area > sums - offset * area, 255, 0).astype(np.uint8)
+
+
+def median_denoise(gray: np.ndarray) -> np.ndarray:
+    """3x3 median filter over stacked shifted views."""
+    padded = np.pad(gray, 1, mode="edge")
+    h, w = gray.shape
+    stack = np.stack([padded[dy:dy + h, dx:dx + w] for dy in range(3) for dx in range(3)])
+    return np.partition(stack, 4, axis=0)[4]
+
+
+def estimate_skew(gray: np.ndarray) -> float:
+    """Angle (degrees) whose rotation gives the sharpest horizontal projection profile."""
+    image = Image.fromarray(gray)
+    if image.width > DESKEW_WIDTH:
+        image = image.resize((DESKEW_WIDTH, max(1, image.height * DESKEW_WIDTH // image.width)))
+    ink = Image.fromarray(np.where(np.asarray(image) < 128, 255, 0).astype(np.uint8))
+
+    best_angle, best_score = 0.0, -1.0
+    for angle in np.arange(-DESKEW_MAX_ANGLE, DESKEW_MAX_ANGLE + DESKEW_STEP / 2, DESKEW_STEP):
+        rows = np.asarray(ink.rotate(float(angle), fillcolor=0)).sum(axis=1, dtype=np.float64)
+        score = float(np.var(rows))
+        if score > best_score:
+            best_angle, best_score = float(angle), score
+    return best_angle
+
+
+def deskew(gray: np.ndarray) -> np.ndarray:
+    angle = estimate_skew(gray)
+    if abs(angle) < DESKEW_STEP / 2:
+        return gray
+    return np.asarray(Image.fromarray(gray).rotate(angle, resample=Image.BILINEAR, fillcolor=255))
+
+
+def dpi_scale(image: Image.Image, steps) -> float:
+    """Factor zone coordinates must be multiplied by to match the preprocessed page."""
+    if "dpi" not in steps:
+        return 1.0
+    dpi = image.info.get("dpi")
+    try:
+        source = float(dpi[0])
+    except (TypeError, ValueError, IndexError):
+        return 1.0
+    if not MIN_DPI <= source <= MAX_DPI:
+        return 1.0
+    return min(TARGET_DPI / source, MAX_UPSCALE)
+
+
+def run(image: Image.Image, preset: str = DEFAULT_PRESET):
+    """Apply a preset and return (image, scale, timings in ms)."""
+    steps = PRESETS[preset]
+    timings = {}
+    scale = dpi_scale(image, steps)
+    if not steps:
+        return image, scale, timings
+
+    arr = None
+    for step in steps:
+        started = time.perf_counter()
+        if step == "dpi":
+            if scale != 1.0:
+                image = image.resize((round(image.width * scale), round(image.height * scale)), Image.LANCZOS)
+        else:
+            if arr is None:
+                arr = np.asarray(image.convert("RGB") if image.mode not in ("L", "RGB") else image)
+            if step == "gray":
+                arr = to_gray(arr)
+            elif step == "deskew":
+                arr = deskew(to_gray(arr))
+            elif step == "denoise":
+                arr = median_denoise(to_gray(arr))
+            elif step == "threshold":
+                arr = adaptive_threshold(to_gray(arr))
+        timings[step] = round((time.perf_counter() - started) * 1000, 1)
+
+    if arr is not None:
+        image = Image.fromarray(arr)
+    return image, scale, timings
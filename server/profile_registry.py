@@ -0,0 +1,180 @@
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional, Tuple
+
+from pydantic import BaseModel, ConfigDict
+
+from field_types import DEFAULT_LANG
+import preprocess
+
+# Parsed profiles kept in memory for all routers. An entry is loaded once and
+# reused until save_profile/delete_profile invalidate it or the files on disk
+# change; mtimes are re-checked at most every CHECK_INTERVAL seconds, so
+# lookups in between do no disk I/O at all.
+PROFILE_DIR = "data/profiles"
+CHECK_INTERVAL = float(os.environ.get("PROFILE_CHECK_INTERVAL", 5))
+DEFAULT_SETTINGS = {
+    "languages": DEFAULT_LANG,
+    "preprocess": preprocess.DEFAULT_PRESET,
+    "itemTable": None,
+    "dpi": 300
+}
+
+os.makedirs(PROFILE_DIR, exist_ok=True)
+
+
+class Zone(BaseModel):
+    # Extra keys stored by the editor (labels, colours, ...) are kept as they are
+    model_config = ConfigDict(frozen=True, extra="allow")
+
+    id: int
+    x: int
+    y: int
+    width: int
+    height: int
+    propertyName: str
+    fieldType: Optional[str] = None
+
+
+def normalize_zone(zone: dict) -> Zone:
+    """Validate one stored zone; coordinates saved as floats are truncated to pixels."""
+    zone = dict(zone)
+    for key in ("x", "y", "width", "height"):
+        if key in zone:
+            zone[key] = int(zone[key])
+    return Zone(**zone)
+
+
+@dataclass(frozen=True)
+class Profile:
+    name: str
+    config: list  # config.json as stored, for the profile editor
+    zones: Tuple[Zone, ...]
+    settings: dict
+    created: Optional[str]
+    updated: Optional[str]
+    stamp: tuple
+
+    def zone_dicts(self) -> list:
+        """Fresh, normalised zone dicts (only the keys the profile stores)."""
+        return [z.model_dump(exclude_unset=True) for z in self.zones]
+
+
+_lock = threading.Lock()
+_entries = {}  # name -> (Profile, last check)
+_listing = {"names": None, "checked": 0.0}
+
+
+def _paths(name: str):
+    path = os.path.join(PROFILE_DIR, name)
+    return os.path.join(path, "config.json"), os.path.join(path, "settings.json")
+
+
+def _stamp(name: str):
+    """(config mtime, settings mtime) or None when the profile has no config."""
+    config_path, settings_path = _paths(name)
+    try:
+        config_mtime = os.stat(config_path).st_mtime_ns
+    except OSError:
+        return None
+    try:
+        settings_mtime = os.stat(settings_path).st_mtime_ns
+    except OSError:
+        settings_mtime = None
+    return config_mtime, settings_mtime
+
+
+def _load(name: str, stamp: tuple) -> Profile:
+    config_path, settings_path = _paths(name)
+    with open(config_path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    settings = dict(DEFAULT_SETTINGS)
+    if stamp[1] is not None:
+        with open(settings_path, "r", encoding="utf-8") as f:
+            settings.update(json.load(f))
+    zones = []
+    for zone in config if isinstance(config, list) else []:
+        # Legacy or hand-edited zones (e.g. without propertyName) cannot be
+        # OCRed; they stay in config for the editor but are left out here
+        try:
+            zones.append(normalize_zone(zone))
+        except (TypeError, ValueError) as e:
+            print(f"[PROFILE] {name}: skipping invalid zone {zone!r}: {e}")
+    return Profile(
+        name=name,
+        config=config,
+        zones=tuple(zones),
+        settings=settings,
+        created=datetime.fromtimestamp(os.path.getctime(config_path)).isoformat(),
+        updated=datetime.fromtimestamp(stamp[0] / 1e9).isoformat(),
+        stamp=stamp,
+    )
+
+
+def get(name: str) -> Optional[Profile]:
+    """The profile, or None when it does not exist or its files cannot be read."""
+    now = time.monotonic()
+    cached = _entries.get(name)
+    if cached is not None and now - cached[1] < CHECK_INTERVAL:
+        return cached[0]
+
+    stamp = _stamp(name)
+    with _lock:
+        if stamp is None:
+            _entries.pop(name, None)
+            return None
+        cached = _entries.get(name)
+        if cached is not None and cached[0].stamp == stamp:
+            profile = cached[0]
+        else:
+            try:
+                profile = _load(name, stamp)
+            except (OSError, ValueError) as e:
+                print(f"[PROFILE] Cannot load profile {name}: {e}")
+                _entries.pop(name, None)
+                return None
+        _entries[name] = (profile, now)
+        return profile
+
+
+def info(name: str) -> Optional[dict]:
+    """Created/updated times from the files alone, without parsing the profile."""
+    config_path, _ = _paths(name)
+    try:
+        stat = os.stat(config_path)
+    except OSError:
+        return None
+    return {
+        "created": datetime.fromtimestamp(stat.st_ctime).isoformat(),
+        "updated": datetime.fromtimestamp(stat.st_mtime).isoformat(),
+    }
+
+
+def settings(name: str) -> dict:
+    """Profile OCR settings, or the defaults for an unknown profile."""
+    profile = get(name)
+    return dict(profile.settings if profile is not None else DEFAULT_SETTINGS)
+
+
+def names():
+    now = time.monotonic()
+    if _listing["names"] is None or now - _listing["checked"] >= CHECK_INTERVAL:
+        _listing["names"] = sorted(
+            entry.name for entry in os.scandir(PROFILE_DIR) if entry.is_dir()
+        )
+        _listing["checked"] = now
+    return list(_listing["names"])
+
+
+def invalidate(name: Optional[str] = None):
+    """Drop one profile (or all) so the next lookup reloads it from disk."""
+    with _lock:
+        if name is None:
+            _entries.clear()
+        else:
+            _entries.pop(name, None)
+        _listing["names"] = None
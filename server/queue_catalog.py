@@ -0,0 +1,110 @@
+import json
+import os
+import sqlite3
+import sys
+from contextlib import contextmanager
+from typing import Optional
+
+# Catalog of saved queues so the queue list does not open every meta.json.
+# The folders under data/queues stay the source of truth; save_queue and
+# delete_queue keep the catalog in sync and rebuild() recreates it from the
+# folders. A fresh database is filled automatically on first use.
+QUEUE_DIR = "data/queues"
+DB_PATH = "data/queues.db"
+SORT_COLUMNS = ("updated", "created", "name")
+
+
+@contextmanager
+def _connect():
+    """A connection that commits on success and is always closed."""
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def _init():
+    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    fresh = not os.path.exists(DB_PATH)
+    with _connect() as conn:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS queues (
+                name TEXT PRIMARY KEY,
+                profile TEXT,
+                created TEXT,
+                updated TEXT,
+                page_count INTEGER,
+                meta TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS queues_updated ON queues (updated);
+            CREATE INDEX IF NOT EXISTS queues_profile_updated ON queues (profile, updated);
+        """)
+    if fresh:
+        rebuild()
+
+
+def _row(meta: dict) -> tuple:
+    # The page -> blob hash map is storage detail, not listed
+    listed = {k: v for k, v in meta.items() if k != "blobs"}
+    return (meta["name"], meta.get("profile"), meta.get("created"), meta.get("updated"),
+            len(meta.get("pages", [])), json.dumps(listed, ensure_ascii=False))
+
+
+def upsert(meta: dict):
+    with _connect() as conn:
+        conn.execute("INSERT OR REPLACE INTO queues VALUES (?, ?, ?, ?, ?, ?)", _row(meta))
+
+
+def delete(name: str):
+    with _connect() as conn:
+        conn.execute("DELETE FROM queues WHERE name = ?", (name,))
+
+
+def list_queues(profile: Optional[str] = None, sort: str = "updated", descending: bool = True,
+                limit: Optional[int] = None, offset: int = 0):
+    """Return (queue metas, total count matching the filter)."""
+    if sort not in SORT_COLUMNS:
+        raise ValueError(f"Cannot sort by '{sort}'")
+    where, params = ("WHERE profile = ?", [profile]) if profile else ("", [])
+    order = f"ORDER BY {sort} {'DESC' if descending else 'ASC'}, name"
+    page = "LIMIT ? OFFSET ?" if limit is not None else ""
+    with _connect() as conn:
+        total = conn.execute(f"SELECT COUNT(*) FROM queues {where}", params).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT meta FROM queues {where} {order} {page}",
+            params + ([limit, offset] if limit is not None else [])
+        ).fetchall()
+    return [json.loads(row["meta"]) for row in rows], total
+
+
+def rebuild() -> int:
+    """Recreate the catalog from the meta.json files under QUEUE_DIR."""
+    rows = []
+    for folder in os.listdir(QUEUE_DIR) if os.path.isdir(QUEUE_DIR) else []:
+        meta_path = os.path.join(QUEUE_DIR, folder, "meta.json")
+        if not os.path.exists(meta_path):
+            continue
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                rows.append(_row(json.load(f)))
+        except (OSError, ValueError, KeyError) as e:
+            print(f"[CATALOG] Skipping queue {folder}: {e}")
+    with _connect() as conn:
+        conn.execute("DELETE FROM queues")
+        conn.executemany("INSERT OR REPLACE INTO queues VALUES (?, ?, ?, ?, ?, ?)", rows)
+    return len(rows)
+
+
+_init()
+
+
+if __name__ == "__main__":
+    # python queue_catalog.py rebuild
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("usage: python queue_catalog.py rebuild")
+    print(f"Catalogued {rebuild()} queues")
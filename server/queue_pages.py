@@ -0,0 +1,116 @@
+import json
+import os
+
+import storage
+
+# Per-page storage of queue values. Every page lives in
+# data/queues/<name>/pages/<filename>.json and pages/index.json keeps the page
+# order with a small completion summary, so one page (or the summary) can be
+# read without parsing the whole queue. Queues saved before this layout have
+# a single values.json; it is split into page files on first access.
+PAGES_DIR = "pages"
+INDEX_FILE = "index.json"
+LEGACY_FILE = "values.json"
+READ_ATTEMPTS = 3
+
+
+def _page_path(queue_path: str, filename: str) -> str:
+    return os.path.join(queue_path, PAGES_DIR, f"{os.path.basename(filename)}.json")
+
+
+def _index_path(queue_path: str) -> str:
+    return os.path.join(queue_path, PAGES_DIR, INDEX_FILE)
+
+
+def _write_json(path: str, data, fsync: bool = False):
+    # Only the index, written last, is fsynced: a full save has one page file per page
+    storage.write_json(path, data, fsync=fsync, ensure_ascii=False)
+
+
+def summarize(page: dict) -> dict:
+    """Index entry of a page: how many zone fields it has and how many are filled in."""
+    names = [z.get("propertyName") for z in page.get("zones") or [] if isinstance(z, dict) and z.get("propertyName")]
+    values = page.get("values") or {}
+    filled = sum(1 for n in names if str(values.get(n) or "").strip())
+    return {
+        "filename": page["filename"],
+        "fields": len(names),
+        "filled": filled,
+        "complete": bool(names) and filled == len(names),
+    }
+
+
+def write_all(queue_path: str, pages: list):
+    """Replace every page of the queue."""
+    pages_dir = os.path.join(queue_path, PAGES_DIR)
+    os.makedirs(pages_dir, exist_ok=True)
+    for page in pages:
+        _write_json(_page_path(queue_path, page["filename"]), page)
+    _write_json(_index_path(queue_path), [summarize(page) for page in pages], fsync=True)
+
+    keep = {f"{os.path.basename(page['filename'])}.json" for page in pages} | {INDEX_FILE}
+    for name in os.listdir(pages_dir):
+        if name not in keep and name.endswith(".json"):
+            os.remove(os.path.join(pages_dir, name))
+    legacy_path = os.path.join(queue_path, LEGACY_FILE)
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+
+
+def _migrate(queue_path: str):
+    legacy_path = os.path.join(queue_path, LEGACY_FILE)
+    if os.path.exists(_index_path(queue_path)) or not os.path.exists(legacy_path):
+        return
+    # The queue lock, as for saves: other workers may be migrating or saving it too
+    with storage.locked(queue_path):
+        if os.path.exists(_index_path(queue_path)) or not os.path.exists(legacy_path):
+            return
+        with open(legacy_path, "r", encoding="utf-8") as f:
+            write_all(queue_path, json.load(f))
+
+
+def load_index(queue_path: str) -> list:
+    """Page order and completion summary, one entry per page."""
+    _migrate(queue_path)
+    try:
+        with open(_index_path(queue_path), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def read_page(queue_path: str, filename: str) -> dict:
+    with open(_page_path(queue_path, filename), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def read_range(queue_path: str, start: int = 0, stop=None):
+    """(index, pages[start:stop]) read without the queue lock.
+
+    A save that runs meanwhile may delete page files of the index just read;
+    the read is then repeated with a fresh index, the last time under the lock.
+    """
+    for _ in range(READ_ATTEMPTS):
+        index = load_index(queue_path)
+        try:
+            return index, [read_page(queue_path, entry["filename"]) for entry in index[start:stop]]
+        except FileNotFoundError:
+            continue
+    with storage.locked(queue_path):
+        index = load_index(queue_path)
+        return index, [read_page(queue_path, entry["filename"]) for entry in index[start:stop]]
+
+
+def read_pages(queue_path: str, start: int = 0, stop=None) -> list:
+    return read_range(queue_path, start, stop)[1]
+
+
+def update(queue_path: str, index: list, changed: list, removed=()):
+    """Write changed pages and the new index; index is the summary list in page order."""
+    for page in changed:
+        _write_json(_page_path(queue_path, page["filename"]), page)
+    for filename in removed:
+        path = _page_path(queue_path, filename)
+        if os.path.exists(path):
+            os.remove(path)
+    _write_json(_index_path(queue_path), index, fsync=True)
@@ -3,9 +3,51 @@ from fastapi.responses import JSONResponse
 from zipfile import ZipFile
 from pathlib import Path
 import datetime
+import os
+import sqlite3
+
+import ocr_cache
+import overview_store
+import page_cache
+import queue_catalog
+import storage
+import xml_cache
 
 router = APIRouter()
 
+# Queue images are hard links into the blob store, so the store itself is left
+# out: every blob is already archived through the queue folders that use it,
+# and blob_store relinks them when a restored data/ has no store. Derived
+# caches, lock files and page sessions are rebuilt on demand and left out too.
+# The SQLite databases are copied with the online backup API instead of as
+# files, which could catch them halfway through a write (and without their
+# -wal file, which holds the latest commits).
+SKIP_DIRS = {
+    "blobs",
+    *(Path(d).relative_to("data").parts[0] for d in (
+        ocr_cache.CACHE_DIR, xml_cache.CACHE_DIR, page_cache.SESSION_DIR, storage.LOCK_DIR,
+    )),
+}
+DATABASES = [queue_catalog.DB_PATH, overview_store.DB_PATH]
+SKIP_SUFFIXES = ("-wal", "-shm", "-journal", ".tmp")
+
+
+def _add_database(zipf: ZipFile, db_path: str, arcname: Path):
+    snapshot = storage.temp_path(db_path)
+    try:
+        source = sqlite3.connect(db_path, timeout=30)
+        target = sqlite3.connect(snapshot)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+        zipf.write(snapshot, arcname)
+    finally:
+        if os.path.exists(snapshot):
+            os.remove(snapshot)
+
+
 @router.post("/backup")
 def create_backup():
     data_dir = Path("data")
@@ -13,9 +55,23 @@ def create_backup():
     backup_dir.mkdir(exist_ok=True)
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     zip_path = backup_dir / f"backup_{timestamp}.zip"
+    databases = {Path(p).resolve() for p in DATABASES}
 
     with ZipFile(zip_path, "w") as zipf:
-        for file_path in data_dir.rglob("*"):
-            zipf.write(file_path, file_path.relative_to(data_dir))
+        for root, dirs, files in os.walk(data_dir):
+            root = Path(root)
+            if root == data_dir:
+                dirs[:] = [d for d in dirs if d not in SKIP_DIRS]
+            for name in sorted(dirs):
+                zipf.write(root / name, (root / name).relative_to(data_dir))
+            for name in sorted(files):
+                file_path = root / name
+                relative = file_path.relative_to(data_dir)
+                if name.endswith(SKIP_SUFFIXES):
+                    continue
+                if file_path.resolve() in databases:
+                    _add_database(zipf, str(file_path), relative)
+                else:
+                    zipf.write(file_path, relative)
 
     return JSONResponse(content={"message": "Backup created", "file": zip_path.name})
@@ -1,28 +1,55 @@
 import os
 import json
-from fastapi import APIRouter, UploadFile, File, HTTPException, Body
+from contextlib import contextmanager
+from fastapi import APIRouter, UploadFile, File, HTTPException, Body, Header, Response
 from xml.etree import ElementTree as ET
-from typing import List
+from typing import List, Optional
 from typing import Dict
 
+import storage
+
 router = APIRouter()
 
 BATCH_DIR = "data/bank_batches"
 os.makedirs(BATCH_DIR, exist_ok=True)
 
+@contextmanager
+def edit_batch(batch_name: str, if_match: Optional[str], response: Response):
+    """Locked read-modify-write of a bank batch; yields the operations list.
+
+    A changed list is written back when the block exits without an exception
+    and the current version is returned in the ETag header. A stale If-Match
+    gives 412.
+    """
+    path = os.path.join(BATCH_DIR, f"{batch_name}.json")
+    with storage.locked(path):
+        if not os.path.exists(path):
+            raise HTTPException(status_code=404, detail="Bank batch not found")
+        storage.check_version(path, if_match)
+        operations = storage.read_json(path)
+        before = json.dumps(operations)
+        yield operations
+        if json.dumps(operations) != before:
+            storage.write_json(path, operations, ensure_ascii=False, indent=2)
+        response.headers["ETag"] = storage.version(path)
+
 @router.post("/bank/save_batch")
-def save_batch(name: str = Body(...), operations: List[dict] = Body(...)):
+def save_batch(response: Response, name: str = Body(...), operations: List[dict] = Body(...),
+               if_match: Optional[str] = Header(None)):
     path = os.path.join(BATCH_DIR, f"{name}.json")
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(operations, f, ensure_ascii=False, indent=2)
+    with storage.locked(path):
+        storage.check_version(path, if_match)
+        storage.write_json(path, operations, ensure_ascii=False, indent=2)
+        response.headers["ETag"] = storage.version(path)
     return {"status": "ok", "saved_as": name}
 
 @router.delete("/bank/delete_batch")
 def delete_batch(name: str):
     path = os.path.join(BATCH_DIR, f"{name}.json")
-    if os.path.exists(path):
-        os.remove(path)
-        return {"status": "deleted", "name": name}
+    with storage.locked(path):
+        if os.path.exists(path):
+            os.remove(path)
+            return {"status": "deleted", "name": name}
     raise HTTPException(status_code=404, detail="Batch not found")
 
 @router.get("/bank/list_batches")
@@ -31,12 +58,12 @@ def list_batches():
     return {"batches": sorted(files)}
 
 @router.get("/bank/load_batch")
-def load_batch(name: str):
+def load_batch(name: str, response: Response):
     path = os.path.join(BATCH_DIR, f"{name}.json")
     if not os.path.exists(path):
         raise HTTPException(status_code=404, detail="Batch not found")
-    with open(path, "r", encoding="utf-8") as f:
-        operations = json.load(f)
+    response.headers["ETag"] = storage.version(path)
+    operations = storage.read_json(path)
     return {"operations": operations}
 
 @router.post("/bank/import_xml")
@@ -71,26 +98,18 @@ async def import_bank_xml(file: UploadFile = File(...)):
     return {"count": len(entries), "operations": entries}
 
 @router.post("/bank/save_match")
-def save_match(bank_id: str = Body(...), invoice_id: str = Body(...), batch_name: str = Body(...)):
-    path = os.path.join(BATCH_DIR, f"{batch_name}.json")
-    if not os.path.exists(path):
-        raise HTTPException(status_code=404, detail="Bank batch not found")
-
-    with open(path, "r", encoding="utf-8") as f:
-        operations = json.load(f)
-
-    updated = False
-    for op in operations:
-        if op.get("id") == bank_id:
-            op["matched_invoice_id"] = invoice_id
-            updated = True
-            break
-
-    if not updated:
-        raise HTTPException(status_code=404, detail="Bank operation not found")
-
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(operations, f, ensure_ascii=False, indent=2)
+def save_match(response: Response, bank_id: str = Body(...), invoice_id: str = Body(...), batch_name: str = Body(...),
+               if_match: Optional[str] = Header(None)):
+    with edit_batch(batch_name, if_match, response) as operations:
+        updated = False
+        for op in operations:
+            if op.get("id") == bank_id:
+                op["matched_invoice_id"] = invoice_id
+                updated = True
+                break
+
+        if not updated:
+            raise HTTPException(status_code=404, detail="Bank operation not found")
 
     return {"status": "ok", "matched": {"bank_id": bank_id, "invoice_id": invoice_id}}
 
@@ -100,8 +119,7 @@ def get_match_status(bank_id: str, batch_name: str):
     if not os.path.exists(path):
         raise HTTPException(status_code=404, detail="Bank batch not found")
 
-    with open(path, "r", encoding="utf-8") as f:
-        operations = json.load(f)
+    operations = storage.read_json(path)
 
     for op in operations:
         if op.get("id") == bank_id:
@@ -111,80 +129,55 @@ def get_match_status(bank_id: str, batch_name: str):
 
 @router.post("/bank/save_initial_match")
 def save_initial_match(
+    response: Response,
     batch_name: str = Body(...),
-    matches: Dict[str, str] = Body(...)
+    matches: Dict[str, str] = Body(...),
+    if_match: Optional[str] = Header(None)
 ):
-    path = os.path.join(BATCH_DIR, f"{batch_name}.json")
-    if not os.path.exists(path):
-        raise HTTPException(status_code=404, detail="Bank batch not found")
-
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    updated = False
-    for op in data:
-        if op["id"] in matches:
-            op["initial_match"] = matches[op["id"]]
-            updated = True
-
-    if updated:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+    with edit_batch(batch_name, if_match, response) as data:
+        for op in data:
+            if op["id"] in matches:
+                op["initial_match"] = matches[op["id"]]
 
     return {"status": "ok", "count": len(matches)}
 
 @router.post("/bank/confirm_match")
 def confirm_match(
+    response: Response,
     batch_name: str = Body(...),
     bank_id: str = Body(...),
-    invoice_id: str = Body(...)
+    invoice_id: str = Body(...),
+    if_match: Optional[str] = Header(None)
 ):
-    path = os.path.join(BATCH_DIR, f"{batch_name}.json")
-    if not os.path.exists(path):
-        raise HTTPException(status_code=404, detail="Bank batch not found")
+    with edit_batch(batch_name, if_match, response) as data:
+        updated = False
+        for op in data:
+            if op["id"] == bank_id:
+                op["initial_match"] = invoice_id
+                op["confirm_match"] = True
+                updated = True
+                break
+
+        if not updated:
+            raise HTTPException(status_code=404, detail="Bank operation not found")
+    return {"status": "ok", "confirmed": bank_id}
 
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    updated = False
-    for op in data:
-        if op["id"] == bank_id:
-            op["initial_match"] = invoice_id
-            op["confirm_match"] = True
-            updated = True
-            break
-
-    if updated:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        return {"status": "ok", "confirmed": bank_id}
-    else:
-        raise HTTPException(status_code=404, detail="Bank operation not found")
-    
 @router.post("/bank/delete_match")
 def delete_match(
+    response: Response,
     batch_name: str = Body(...),
-    bank_id: str = Body(...)
+    bank_id: str = Body(...),
+    if_match: Optional[str] = Header(None)
 ):
-    path = os.path.join(BATCH_DIR, f"{batch_name}.json")
-    if not os.path.exists(path):
-        raise HTTPException(status_code=404, detail="Bank batch not found")
-
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    updated = False
-    for op in data:
-        if op["id"] == bank_id:
-            op["initial_match"] = None
-            op["confirm_match"] = False
-            updated = True
-            break
-
-    if updated:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        return {"status": "ok", "cleared": bank_id}
-    else:
-        raise HTTPException(status_code=404, detail="Bank operation not found")
-
+    with edit_batch(batch_name, if_match, response) as data:
+        updated = False
+        for op in data:
+            if op["id"] == bank_id:
+                op["initial_match"] = None
+                op["confirm_match"] = False
+                updated = True
+                break
+
+        if not updated:
+            raise HTTPException(status_code=404, detail="Bank operation not found")
+    return {"status": "ok", "cleared": bank_id}
@@ -2,6 +2,7 @@ import csv
 import io
 import os
 import re
+import shutil
 import tempfile
 import zipfile
 import requests
@@ -16,6 +17,9 @@ import xml.dom.minidom
 
 from fastapi import APIRouter, UploadFile, File, HTTPException
 from fastapi.responses import StreamingResponse, FileResponse
+from starlette.background import BackgroundTask
+
+import janitor
 
 
 router = APIRouter()
@@ -320,25 +324,30 @@ async def convert_stripe_invoices(files: list[UploadFile] = File(...)):
 @router.post("/convert/dph-cz")
 async def convert_dph_confirmation(files: list[UploadFile] = File(...)):
     invoice_counter = 1
-    tempdir = tempfile.mkdtemp()
+    # Removed after the response is sent; the janitor sweeps it if that never happens
+    tempdir = janitor.scratch_dir("dph")
     doklady_with_dates = []
 
     def safe_text(val):
         return str(val).strip() if val else ""
 
     def decode_hex_xml(p7s_bytes):
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".p7s") as f:
+        with tempfile.NamedTemporaryFile(suffix=".p7s", dir=tempdir) as f:
             f.write(p7s_bytes)
             f.flush()
             temp_out = f.name + ".xml"
-            result = subprocess.run(
-                ["openssl", "smime", "-verify", "-in", f.name, "-inform", "DER", "-noverify", "-out", temp_out],
-                capture_output=True
-            )
-            if result.returncode != 0:
-                return None
-            with open(temp_out, "r", encoding="utf-8") as out:
-                return out.read()
+            try:
+                result = subprocess.run(
+                    ["openssl", "smime", "-verify", "-in", f.name, "-inform", "DER", "-noverify", "-out", temp_out],
+                    capture_output=True
+                )
+                if result.returncode != 0:
+                    return None
+                with open(temp_out, "r", encoding="utf-8") as out:
+                    return out.read()
+            finally:
+                if os.path.exists(temp_out):
+                    os.remove(temp_out)
 
     def extract_inner_xml(content: str):
         outer = ET.fromstring(content)
@@ -476,7 +485,8 @@ async def convert_dph_confirmation(files: list[UploadFile] = File(...)):
             ET.ElementTree(single_root).write(separate_path, encoding="utf-8", xml_declaration=True)
             zipf.write(separate_path, arcname=separate_filename)
 
-    return FileResponse(zip_path, filename=zip_filename, media_type="application/zip")
+    return FileResponse(zip_path, filename=zip_filename, media_type="application/zip",
+                        background=BackgroundTask(shutil.rmtree, tempdir, ignore_errors=True))
 
 def process_zasilkovna_csv(content: str, original_filename: str, output_dir: str) -> tuple[str, str]:
     reference_id = os.path.splitext(original_filename)[0]
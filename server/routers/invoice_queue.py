@@ -1,15 +1,21 @@
-from fastapi import APIRouter, UploadFile, Form, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, UploadFile, Form, Header, HTTPException, Query, Request, Response
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 import os
 import shutil
 import json
 from datetime import datetime
 
+import blob_store
+import image_cache
+import page_index
+import queue_catalog
+import queue_pages
+import storage
+
 router = APIRouter()
 
-QUEUE_DIR = "data/queues"
+QUEUE_DIR = queue_catalog.QUEUE_DIR
 os.makedirs(QUEUE_DIR, exist_ok=True)
 
 class InvoiceQueue(BaseModel):
@@ -20,93 +26,342 @@ class InvoiceQueue(BaseModel):
     pages: List[str]  # filenames
 
 @router.get("/queues")
-def list_queues():
-    result = []
-    for folder in os.listdir(QUEUE_DIR):
-        meta_path = os.path.join(QUEUE_DIR, folder, "meta.json")
-        if os.path.exists(meta_path):
-            with open(meta_path, "r", encoding="utf-8") as f:
-                result.append(json.load(f))
+def list_queues(
+    response: Response,
+    profile: Optional[str] = None,
+    sort: str = "updated",
+    order: str = "desc",
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    offset: int = Query(0, ge=0)
+):
+    """Queue metadata from the catalog; X-Total-Count holds the number of matching queues."""
+    if sort not in queue_catalog.SORT_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of {', '.join(queue_catalog.SORT_COLUMNS)}")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="order must be 'asc' or 'desc'")
+    result, total = queue_catalog.list_queues(profile, sort, order == "desc", limit, offset)
+    response.headers["X-Total-Count"] = str(total)
     return result
 
-@router.get("/queues/{name}")
-def get_queue(name: str):
-    queue_path = os.path.join(QUEUE_DIR, name)
-    meta_path = os.path.join(queue_path, "meta.json")
-    values_path = os.path.join(queue_path, "values.json")
+@router.post("/queues/catalog/rebuild")
+def rebuild_queue_catalog():
+    return {"queues": queue_catalog.rebuild()}
 
+def _read_meta(queue_path: str) -> dict:
+    meta_path = os.path.join(queue_path, "meta.json")
     if not os.path.exists(meta_path):
         raise HTTPException(status_code=404, detail="Queue not found")
+    return storage.read_json(meta_path)
 
-    with open(meta_path, "r", encoding="utf-8") as f:
-        meta = json.load(f)
-    with open(values_path, "r", encoding="utf-8") as f:
-        values = json.load(f)
+@router.get("/queues/{name}")
+def get_queue(
+    response: Response,
+    name: str,
+    start: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1),
+    summary: bool = False
+):
+    """A saved queue with its pages.
+
+    start/limit return a range of pages; summary=true returns only the page
+    list with completion state. pageCount is always the full page count.
+    The ETag can be sent back as If-Match when saving or patching the queue.
+    """
+    queue_path = os.path.join(QUEUE_DIR, name)
+    meta = _read_meta(queue_path)
+    response.headers["ETag"] = storage.version(os.path.join(queue_path, "meta.json"))
+    stop = start + limit if limit is not None else None
+
+    if summary:
+        index = queue_pages.load_index(queue_path)
+        pages = index[start:stop]
+    else:
+        index, pages = queue_pages.read_range(queue_path, start, stop)
 
     return {
         "name": meta["name"],
         "profile": meta["profile"],
         "created": meta["created"],
         "updated": meta["updated"],
-        "pages": values,
+        "pages": pages,
+        "pageCount": len(index),
+        "start": start,
+        "completed": sum(1 for entry in index if entry["complete"]),
         "systemValues": meta.get("systemValues", {}),  # <-- include on GET
         "fieldMapping": meta.get("fieldMapping", {})  # <-- Add this
     }
 
+@router.get("/queues/{name}/pages/{number}")
+def get_queue_page(name: str, number: int):
+    """One page (zero-based) of a queue, read without loading the others."""
+    queue_path = os.path.join(QUEUE_DIR, name)
+    _read_meta(queue_path)
+    if number < 0:
+        raise HTTPException(status_code=404, detail="Page not found")
+    _, pages = queue_pages.read_range(queue_path, number, number + 1)
+    if not pages:
+        raise HTTPException(status_code=404, detail="Page not found")
+    return pages[0]
+
+def _write_meta(queue_path: str, meta: dict):
+    storage.write_json(os.path.join(queue_path, "meta.json"), meta, indent=2)
+    queue_catalog.upsert(meta)
+
+def _index_pages(name: str, profile: str, pages: list, blobs: dict):
+    # Checked values are what later copies of these pages should reuse
+    queue_path = os.path.join(QUEUE_DIR, name)
+    for page in pages:
+        filename = page.get("filename") if isinstance(page, dict) else None
+        if not filename or not os.path.isfile(os.path.join(queue_path, filename)):
+            continue
+        try:
+            page_index.add_file(os.path.join(queue_path, filename),
+                                {"source": "queue", "name": name, "filename": filename},
+                                profile, page.get("values"), verified=True, sha=blobs.get(filename))
+        except Exception as e:
+            print(f"[QUEUE] Cannot index {filename}: {e}")
+
 @router.post("/queues")
 def save_queue(
+    response: Response,
     name: str = Form(...),
     profile: str = Form(...),
     values: str = Form(...),
     systemValues: str = Form(None),  # <-- already present
     fieldMapping: str = Form(None),  # <-- New input
-    files: List[UploadFile] = []
+    files: List[UploadFile] = [],
+    if_match: Optional[str] = Header(None)
 ):
+    try:
+        pages = json.loads(values)
+        if not isinstance(pages, list) or not all(isinstance(p, dict) and p.get("filename") for p in pages):
+            raise ValueError("expected a list of pages with filenames")
+        system_values = json.loads(systemValues) if systemValues else {}
+        field_mapping = json.loads(fieldMapping) if fieldMapping else {}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid values: {e}")
+
     queue_path = os.path.join(QUEUE_DIR, name)
     os.makedirs(queue_path, exist_ok=True)
+    meta_path = os.path.join(queue_path, "meta.json")
 
-    # Save images
-    saved_filenames = []
-    for file in files:
-        out_path = os.path.join(queue_path, file.filename)
-        with open(out_path, "wb") as f:
-            shutil.copyfileobj(file.file, f)
-        saved_filenames.append(file.filename)
+    # Images go into the blob store first; identical content is stored once.
+    # Anything failing before the queue is written releases them again.
+    stored = {}
+    try:
+        for file in files:
+            stored[os.path.basename(file.filename)] = blob_store.put(file.file)
 
-    # Save meta and values
-    now = datetime.utcnow().isoformat()
-    meta_path = os.path.join(queue_path, "meta.json")
-    existing = os.path.exists(meta_path)
-
-    meta = {
-        "name": name,
-        "profile": profile,
-        "created": now if not existing else json.load(open(meta_path)).get("created", now),
-        "updated": now,
-        "pages": saved_filenames,
-        "systemValues": json.loads(systemValues) if systemValues else {},  # <-- save it
-        "fieldMapping": json.loads(fieldMapping) if fieldMapping else {}  # <-- New line
-    }
+        with storage.locked(queue_path):
+            storage.check_version(meta_path, if_match)
+            existing = storage.read_json(meta_path) if os.path.exists(meta_path) else None
 
-    with open(meta_path, "w", encoding="utf-8") as f:
-        json.dump(meta, f, indent=2)
+            # Pages still listed keep their stored image unless a new one was uploaded
+            previous = dict(existing.get("blobs", {})) if existing else {}
+            listed = {page["filename"] for page in pages}
+            blobs = {f: sha for f, sha in previous.items() if f in listed}
+            blobs.update(stored)
+            for filename, sha in stored.items():
+                blob_store.link(sha, os.path.join(queue_path, filename))
 
-    with open(os.path.join(queue_path, "values.json"), "w", encoding="utf-8") as f:
-        f.write(values)
+            # Save meta and values
+            now = datetime.utcnow().isoformat()
+            meta = {
+                "name": name,
+                "profile": profile,
+                "created": existing.get("created", now) if existing else now,
+                "updated": now,
+                "pages": list(stored),
+                "systemValues": system_values,  # <-- save it
+                "fieldMapping": field_mapping,  # <-- New line
+                "blobs": blobs
+            }
+
+            queue_pages.write_all(queue_path, pages)
+            _write_meta(queue_path, meta)
+            response.headers["ETag"] = storage.version(meta_path)
+
+            for filename in previous:
+                image_path = os.path.join(queue_path, filename)
+                if filename not in blobs and os.path.exists(image_path):
+                    os.remove(image_path)
+    except BaseException:
+        for sha in stored.values():
+            blob_store.release(sha)
+        raise
+
+    # Images replaced or dropped by this save
+    for filename, sha in previous.items():
+        if blobs.get(filename) != sha:
+            blob_store.release(sha)
+    _index_pages(name, profile, pages, blobs)
 
     return {"status": "ok"}
 
+def _check_changes(changes):
+    """Raise ValueError unless changes has the shape patch_queue documents."""
+    if not isinstance(changes, dict):
+        raise ValueError("changes must be an object")
+    pages = changes.get("pages", {})
+    if not isinstance(pages, dict):
+        raise ValueError("'pages' must be an object keyed by filename")
+    for filename, delta in pages.items():
+        if not isinstance(delta, dict):
+            raise ValueError(f"change of page '{filename}' must be an object")
+        if not isinstance(delta.get("values") or {}, dict):
+            raise ValueError(f"'values' of page '{filename}' must be an object")
+        if "zones" in delta and not isinstance(delta["zones"], list):
+            raise ValueError(f"'zones' of page '{filename}' must be a list")
+    added = changes.get("add", [])
+    if not isinstance(added, list) or not all(isinstance(page, dict) for page in added):
+        raise ValueError("'add' must be a list of pages")
+    for page in added:
+        if not isinstance(page.get("filename"), str):
+            raise ValueError("added pages need a filename")
+        if not isinstance(page.get("values", {}), dict) or not isinstance(page.get("zones", []), list):
+            raise ValueError(f"added page '{page['filename']}' has malformed values or zones")
+    removed = changes.get("remove", [])
+    if not isinstance(removed, list) or not all(isinstance(f, str) for f in removed):
+        raise ValueError("'remove' must be a list of filenames")
+    if "profile" in changes and not isinstance(changes["profile"], str):
+        raise ValueError("'profile' must be a string")
+    for key in ("systemValues", "fieldMapping"):
+        if key in changes and not isinstance(changes[key], dict):
+            raise ValueError(f"'{key}' must be an object")
+
+@router.patch("/queues/{name}")
+def patch_queue(
+    response: Response,
+    name: str,
+    changes: str = Form(...),
+    files: List[UploadFile] = [],
+    if_match: Optional[str] = Header(None)
+):
+    """Apply a delta to a saved queue instead of re-sending it whole.
+
+    changes is a JSON object with any of:
+      "pages":  {filename: {"values": {field: value or null}, "zones": [...]}}
+                null removes a field; zones, when given, replace the page's zones
+      "add":    [{"filename": ..., "sha256": ..., "values": {...}, "zones": [...]}]
+                appended pages; the image is taken from the blob store when
+                sha256 is known, otherwise from the upload with that filename
+      "remove": [filename, ...]
+      "profile", "systemValues", "fieldMapping": replaced when present
+
+    When an added page's image is neither stored nor uploaded, nothing is
+    applied and 409 lists the missing filenames so they can be re-sent.
+    With If-Match, a queue changed since that ETag is left alone and 412 returned.
+    """
+    queue_path = os.path.join(QUEUE_DIR, name)
+    _read_meta(queue_path)
+    try:
+        changes = json.loads(changes)
+        _check_changes(changes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid changes: {e}")
+
+    with storage.locked(queue_path):
+        meta = _read_meta(queue_path)
+        storage.check_version(os.path.join(queue_path, "meta.json"), if_match)
+        index = queue_pages.load_index(queue_path)
+        blobs = dict(meta.get("blobs", {}))
+        by_name = {entry["filename"]: entry for entry in index}
+
+        unknown = [f for f in list(changes.get("pages", {})) + changes.get("remove", []) if f not in by_name]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown pages: {', '.join(unknown)}")
+
+        # Store uploads first; blobs already on disk need no upload at all.
+        # Uploads are released again when the delta is rejected.
+        uploads = {os.path.basename(file.filename): file for file in files}
+        added = changes.get("add", [])
+        missing = []
+        stored = {}
+        try:
+            for page in added:
+                filename = os.path.basename(page.get("filename", ""))
+                if not filename or filename in by_name:
+                    raise HTTPException(status_code=400, detail=f"Cannot add page '{filename}'")
+                if filename in uploads:
+                    stored[filename] = blob_store.put(uploads[filename].file)
+                    if page.get("sha256") and page["sha256"] != stored[filename]:
+                        raise HTTPException(status_code=400,
+                                            detail=f"Upload of '{filename}' does not match its sha256")
+                elif blob_store.exists(page.get("sha256")):
+                    stored[filename] = page["sha256"]
+                else:
+                    missing.append(filename)
+            if missing:
+                raise HTTPException(status_code=409, detail={"missing": missing})
+        except BaseException:
+            for sha in stored.values():
+                blob_store.release(sha)
+            raise
+
+        # Only the pages named in the delta are read and rewritten
+        touched = []
+        for filename, delta in changes.get("pages", {}).items():
+            page = queue_pages.read_page(queue_path, filename)
+            for field, value in (delta.get("values") or {}).items():
+                if value is None:
+                    page.setdefault("values", {}).pop(field, None)
+                else:
+                    page.setdefault("values", {})[field] = value
+            if "zones" in delta:
+                page["zones"] = delta["zones"]
+            touched.append(page)
+
+        for filename in changes.get("remove", []):
+            index.remove(by_name.pop(filename))
+            image_path = os.path.join(queue_path, filename)
+            if os.path.exists(image_path):
+                os.remove(image_path)
+            if filename in blobs:
+                blob_store.release(blobs.pop(filename))
+
+        for page in added:
+            filename = os.path.basename(page["filename"])
+            blob_store.link(stored[filename], os.path.join(queue_path, filename))
+            blobs[filename] = stored[filename]
+            new_page = {"filename": filename, "zones": page.get("zones", []), "values": page.get("values", {})}
+            index.append({"filename": filename})
+            touched.append(new_page)
+
+        for key in ("profile", "systemValues", "fieldMapping"):
+            if key in changes:
+                meta[key] = changes[key]
+        meta["updated"] = datetime.utcnow().isoformat()
+        meta["pages"] = [entry["filename"] for entry in index]
+        meta["blobs"] = blobs
+
+        summaries = {page["filename"]: queue_pages.summarize(page) for page in touched}
+        index = [summaries.get(entry["filename"], entry) for entry in index]
+        queue_pages.update(queue_path, index, touched, changes.get("remove", []))
+        _write_meta(queue_path, meta)
+        response.headers["ETag"] = storage.version(os.path.join(queue_path, "meta.json"))
+
+    _index_pages(name, meta["profile"], touched, blobs)
+    return {"status": "ok", "updated": meta["updated"], "pages": len(index)}
+
 @router.delete("/queues/{name}")
 def delete_queue(name: str):
     queue_path = os.path.join(QUEUE_DIR, name)
-    if not os.path.exists(queue_path):
-        raise HTTPException(status_code=404, detail="Queue not found")
-    shutil.rmtree(queue_path)
+    with storage.locked(queue_path):
+        if not os.path.exists(queue_path):
+            raise HTTPException(status_code=404, detail="Queue not found")
+        blobs = {}
+        meta_path = os.path.join(queue_path, "meta.json")
+        if os.path.exists(meta_path):
+            blobs = storage.read_json(meta_path).get("blobs", {})
+        shutil.rmtree(queue_path)
+    for sha in blobs.values():
+        blob_store.release(sha)
+    queue_catalog.delete(name)
     return {"status": "deleted"}
 
 @router.get("/queues/{name}/{filename}")
-def get_queue_image(name: str, filename: str):
+def get_queue_image(request: Request, name: str, filename: str, size: Optional[str] = None):
     image_path = os.path.join(QUEUE_DIR, name, filename)
     if not os.path.exists(image_path):
         raise HTTPException(status_code=404, detail="Image not found")
-    return FileResponse(image_path)
+    return image_cache.serve_image(request, image_path, size)
@@ -0,0 +1,128 @@
+from fastapi import APIRouter, Form, HTTPException, Body
+from fastapi.responses import FileResponse, StreamingResponse
+from typing import List
+import asyncio
+import json
+import os
+
+import batch_ocr
+import janitor
+import jobs
+import profile_registry
+from routers.overview import iter_flexibee_xml
+from routers.process_zip import TEMP_DIR, list_batch_images
+
+router = APIRouter()
+
+FOLLOW_INTERVAL = 0.5  # seconds between polls when streaming a running job
+
+def _get_job(job_id: str) -> jobs.Job:
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@router.post("/jobs/batch-ocr")
+def submit_batch_ocr(batch_id: str = Form(...), profile: str = Form(...)):
+    """OCR every page of an uploaded /process-zip batch in the background."""
+    batch_dir = os.path.join(TEMP_DIR, batch_id)
+    if not os.path.isdir(batch_dir):
+        raise HTTPException(status_code=404, detail="Batch not found")
+    profile_data = profile_registry.get(profile)
+    if profile_data is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+
+    zones = profile_data.zone_dicts()
+    settings = profile_data.settings
+    filenames = list_batch_images(batch_dir)
+    janitor.touch(batch_id)
+
+    def run(job: jobs.Job):
+        pages = [None] * len(filenames)
+        paths = [os.path.join(batch_dir, name) for name in filenames]
+        for i, result in batch_ocr.iter_pages(paths, zones, settings["languages"], settings["preprocess"],
+                                              table=settings["itemTable"], cancelled=lambda: job.cancelled):
+            pages[i] = {
+                "filename": filenames[i],
+                "imageUrl": f"/temp/{batch_id}/{filenames[i]}",
+                "zones": zones,
+                **result
+            }
+            job.advance(pages[i])
+        job.check_cancelled()
+        with open(job.set_artifact("pages.json", "application/json"), "w", encoding="utf-8") as f:
+            json.dump({"pages": pages}, f, ensure_ascii=False)
+
+    job = jobs.submit("batch-ocr", run, total=len(filenames), params={"batch_id": batch_id, "profile": profile})
+    return job.state
+
+@router.post("/jobs/export-flexibee")
+def submit_export_flexibee(selected_ids: List[str] = Body(...)):
+    def run(job: jobs.Job):
+        def progress():
+            job.check_cancelled()
+            job.advance()
+        with open(job.set_artifact("export_flexibee.xml", "application/xml"), "wb") as f:
+            for chunk in iter_flexibee_xml(selected_ids, progress=progress):
+                f.write(chunk)
+
+    job = jobs.submit("export-flexibee", run, total=len(selected_ids), params={"count": len(selected_ids)})
+    return job.state
+
+@router.get("/jobs")
+def list_jobs():
+    return sorted(jobs.list_jobs(), key=lambda j: j["created"], reverse=True)
+
+@router.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    return _get_job(job_id).state
+
+@router.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    job = _get_job(job_id)
+    if job.state["status"] in jobs.FINISHED:
+        raise HTTPException(status_code=409, detail=f"Job already {job.state['status']}")
+    job.cancel()
+    return {"status": "cancelling", "id": job_id}
+
+@router.delete("/jobs/{job_id}")
+def delete_job(job_id: str):
+    """Remove a finished job and its artifact once the client has it."""
+    deleted = jobs.delete(job_id)
+    if deleted is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if not deleted:
+        raise HTTPException(status_code=409, detail="Job is still running, cancel it first")
+    return {"status": "deleted", "id": job_id}
+
+@router.get("/jobs/{job_id}/results")
+async def stream_job_results(job_id: str, offset: int = 0, follow: bool = False):
+    """Incremental results as NDJSON; with follow=true the stream stays open until the job ends."""
+    job = _get_job(job_id)
+
+    async def generate():
+        sent = offset
+        current = job
+        while True:
+            finished = current.state["status"] in jobs.FINISHED
+            for line in jobs.iter_results(current, sent):
+                sent += 1
+                yield line
+            if finished or not follow:
+                return
+            await asyncio.sleep(FOLLOW_INTERVAL)
+            # Re-read the state: the job may be running in another worker
+            current = jobs.get(job_id)
+            if current is None:
+                return  # deleted meanwhile
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+@router.get("/jobs/{job_id}/artifact")
+def get_job_artifact(job_id: str):
+    job = _get_job(job_id)
+    path = job.artifact_path()
+    if path is None or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Artifact not available")
+    artifact = job.state["artifact"]
+    return FileResponse(path, media_type=artifact["media_type"], filename=artifact["filename"])
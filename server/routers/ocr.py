@@ -1,13 +1,35 @@
-from fastapi import APIRouter, UploadFile, File, Form
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 from PIL import Image
-import pytesseract
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import io
 import json
+import re
+import threading
+import time
+
+import field_types
+import item_table
+import ocr_cache
+import ocr_engine
+import page_cache
+import preprocess
+from routers.profiles import load_profile_settings
 
 router = APIRouter()
 
+OCR_LANG = field_types.DEFAULT_LANG
+# Page mode: a word belongs to a zone when this share of its box lies inside
+PAGE_WORD_OVERLAP = 0.5
+# Words overlapping a zone edge by less than this are not considered straddling
+PAGE_EDGE_OVERLAP = 0.2
+# Zones whose mapped words average below this confidence are re-read by crop
+PAGE_MIN_CONF = 50.0
+
 class Zone(BaseModel):
     id: int
     x: int
@@ -15,45 +37,408 @@ class Zone(BaseModel):
     width: int
     height: int
     propertyName: str
+    fieldType: Optional[str] = None
 
 class OCRResult(BaseModel):
     propertyName: str
     text: str
     success: bool
+    confidence: Optional[float] = None
+    tier: Optional[str] = None
 
-@router.post("/test")
-async def ocr_test(image: UploadFile = File(...), zones: str = Form(...)):
-    zone_list = [Zone(**z) for z in json.loads(zones)]
+# Cascade: a zone stops escalating once a tier reaches this confidence
+CASCADE_MIN_CONF = 75.0
+UPSCALE_FACTOR = 2
+BINARY_THRESHOLD = 160
 
-    image_bytes = await image.read()
-    pil_image = Image.open(io.BytesIO(image_bytes))
-
-    results = []
-
-    for zone in zone_list:
-        crop_box = (
-            zone.x,
-            zone.y,
-            zone.x + zone.width,
-            zone.y + zone.height
-        )
-        cropped = pil_image.crop(crop_box)
+_cascade_lock = threading.Lock()
+_cascade_stats = {"zones": 0, "tiers": {}}
+
+# Zones of a streamed test run concurrently, one per pooled engine
+_zone_executor = ThreadPoolExecutor(max_workers=ocr_engine.POOL_SIZE)
+
+def _identity(image: Image.Image) -> Image.Image:
+    return image
+
+def _upscale(image: Image.Image) -> Image.Image:
+    return image.resize((image.width * UPSCALE_FACTOR, image.height * UPSCALE_FACTOR), Image.LANCZOS)
+
+def _binarize(image: Image.Image) -> Image.Image:
+    return _upscale(image).convert("L").point(lambda p: 255 if p > BINARY_THRESHOLD else 0)
+
+def cascade_tiers(field_type: str, lang: str) -> list:
+    """Ordered (name, transform, ocr config) steps, cheapest first."""
+    config = field_types.ocr_config(field_type, lang)
+    tiers = [
+        ("fast", _identity, config),
+        ("upscale", _upscale, config),
+        ("binarize", _binarize, config),
+    ]
+    if field_type != "text":
+        # Give up on the whitelist and read it as free text
+        tiers.append(("text", _upscale, field_types.ocr_config("text", lang)))
+    else:
+        wider = "+".join(dict.fromkeys(lang.split("+") + OCR_LANG.split("+")))
+        # Nothing to add when the field already uses every language
+        if wider != lang:
+            tiers.append(("languages", _upscale, {"lang": wider, "psm": 6, "whitelist": None}))
+    return tiers
+
+def recognize(image: Image.Image, image_hash: Optional[str], crop_box, lang: str,
+              psm: Optional[int] = None, whitelist: Optional[str] = None, tier: str = "fast",
+              transform=None):
+    """OCR an (already cropped) image, going through the result cache when the source hash is known.
+
+    transform(image) is only applied when the result is not cached.
+    Returns (text, confidence).
+    """
+    def compute():
+        source = transform(image) if transform is not None else image
+        return list(ocr_engine.recognize(source, lang=lang, psm=psm, whitelist=whitelist))
+
+    if image_hash is None:
+        return tuple(compute())
+    config = f"{tier}|{ocr_engine.build_config(psm, whitelist)}"
+    key = ocr_cache.make_key(image_hash, crop_box, lang, config)
+    return tuple(ocr_cache.get_or_compute(key, compute))
+
+def _record_tier(tier: str):
+    with _cascade_lock:
+        _cascade_stats["zones"] += 1
+        _cascade_stats["tiers"][tier] = _cascade_stats["tiers"].get(tier, 0) + 1
+
+def ocr_zone(pil_image: Image.Image, zone: Zone, image_hash: Optional[str] = None, lang: str = OCR_LANG) -> OCRResult:
+    crop_box = (
+        zone.x,
+        zone.y,
+        zone.x + zone.width,
+        zone.y + zone.height
+    )
+    cropped = pil_image.crop(crop_box)
+    field_type = field_types.resolve(zone.fieldType, zone.propertyName)
+    value, confidence, tier = "", 0.0, None
+    try:
+        for name, transform, config in cascade_tiers(field_type, lang):
+            text, conf = recognize(cropped, image_hash, crop_box, config["lang"],
+                                   psm=config["psm"], whitelist=config["whitelist"], tier=name,
+                                   transform=transform)
+            text = text.strip()
+            if text and (not value or conf > confidence):
+                value, confidence, tier = text, conf, name
+            if value and confidence >= CASCADE_MIN_CONF:
+                break
+        if not value or value == "NaN":
+            # Fallback to digit-only mode
+            config = field_types.ocr_config("amount")
+            value, confidence = recognize(cropped, image_hash, crop_box, config["lang"],
+                                          psm=config["psm"], whitelist=config["whitelist"], tier="digits")
+            value = value.strip()
+            tier = "digits"
+        success = True if value else False
+    except Exception as e:
+        print(f"[OCR] Error processing zone {zone.id}: {e}")
+        value = "NaN"
+        success = False
+    if tier:
+        _record_tier(tier)
+    print(f"[OCR] Zone {zone.id} ({zone.propertyName}): '{value}' conf={confidence:.0f} tier={tier}")
+    return OCRResult(propertyName=zone.propertyName, text=value if value else "NaN", success=success,
+                     confidence=round(confidence, 1), tier=tier)
+
+def _overlap_ratio(word: dict, zone: Zone) -> float:
+    """Share of the word's box that lies inside the zone."""
+    ix = min(word["left"] + word["width"], zone.x + zone.width) - max(word["left"], zone.x)
+    iy = min(word["top"] + word["height"], zone.y + zone.height) - max(word["top"], zone.y)
+    area = word["width"] * word["height"]
+    if ix <= 0 or iy <= 0 or area <= 0:
+        return 0.0
+    return (ix * iy) / area
+
+def map_words_to_zone(words: List[dict], zone: Zone):
+    """Assemble a zone's text from page words.
+
+    Returns (text, confidence), or None when the zone is empty or ambiguous
+    (a word straddles the zone edge, or recognition confidence is low) so the
+    caller can fall back to cropping the zone.
+    """
+    inside = []
+    for word in words:
+        ratio = _overlap_ratio(word, zone)
+        if ratio >= PAGE_WORD_OVERLAP:
+            inside.append(word)
+        elif ratio > PAGE_EDGE_OVERLAP:
+            return None
+    if not inside:
+        return None
+    confidence = ocr_engine.mean_confidence(inside)
+    if confidence < PAGE_MIN_CONF:
+        return None
+    text = ocr_engine.words_to_text(inside).strip()
+    return (text, confidence) if text else None
+
+def page_words(pil_image: Image.Image, image_hash: Optional[str] = None, lang: str = OCR_LANG,
+               crop_box=None) -> List[dict]:
+    """Word boxes for a whole page, or for a region already cropped to crop_box."""
+    def compute():
+        return ocr_engine.image_to_data(pil_image, lang=lang)
+
+    if image_hash is None:
+        return compute()
+    key = ocr_cache.make_key(image_hash, crop_box, lang, "image_to_data")
+    words = ocr_cache.get_or_compute(key, compute)
+    # JSON round-trips turn the line tuple into a list
+    for word in words:
+        word["line"] = tuple(word["line"])
+    return words
+
+def safe_page_words(pil_image: Image.Image, image_hash: Optional[str] = None, lang: str = OCR_LANG) -> List[dict]:
+    try:
+        return page_words(pil_image, image_hash, lang)
+    except Exception as e:
+        print(f"[OCR] Page recognition failed, falling back to zones: {e}")
+        return []
+
+def ocr_zone_from_words(pil_image: Image.Image, zone: Zone, words: List[dict], image_hash: Optional[str] = None,
+                        lang: str = OCR_LANG) -> OCRResult:
+    """Take the zone's text from the page pass, or crop-OCR it when that is empty or ambiguous."""
+    mapped = map_words_to_zone(words, zone)
+    if mapped is None:
+        return ocr_zone(pil_image, zone, image_hash, lang)
+    value, confidence = mapped
+    _record_tier("page")
+    print(f"[OCR] Zone {zone.id} ({zone.propertyName}): '{value}' conf={confidence:.0f} tier=page")
+    return OCRResult(propertyName=zone.propertyName, text=value, success=True,
+                     confidence=round(confidence, 1), tier="page")
+
+def ocr_page(pil_image: Image.Image, zone_list: List[Zone], image_hash: Optional[str] = None,
+             lang: str = OCR_LANG) -> List[OCRResult]:
+    """Recognise the page once and map words to zones, cropping only the misses."""
+    words = safe_page_words(pil_image, image_hash, lang)
+    results = [ocr_zone_from_words(pil_image, zone, words, image_hash, lang) for zone in zone_list]
+    fallbacks = sum(1 for r in results if r.tier != "page")
+    print(f"[OCR] Page pass: {len(words)} words, {fallbacks}/{len(zone_list)} zones re-read by crop.")
+    return results
+
+def ocr_items(pil_image: Image.Image, table: dict, image_hash: Optional[str] = None,
+              lang: str = OCR_LANG) -> List[dict]:
+    """Invoice line items from the profile's item block, recognised in one pass."""
+    try:
+        return item_table.extract_items(
+            pil_image, table, lambda block, crop_box: page_words(block, image_hash, lang, crop_box))
+    except Exception as e:
+        print(f"[OCR] Item table extraction failed: {e}")
+        return []
+
+def prepare_page(pil_image: Image.Image, image_hash: str, preset: str, page_id: Optional[str] = None):
+    """Run the preprocessing preset once for the whole page.
+
+    Returns (image, cache hash, zone scale, timings). With a page session the
+    result is kept in the page cache, so later zone tests skip the work.
+    """
+    if preset == "none":
+        return pil_image, image_hash, 1.0, {}
+
+    if page_id is not None:
+        timings = {}
+
+        def build(original):
+            image, _, step_timings = preprocess.run(original, preset)
+            timings.update(step_timings)
+            return image
+
+        image = page_cache.get_variant(page_id, f"preprocess:{preset}", build)
+        if image is not None:
+            return image, f"{image_hash}-{preset}", preprocess.dpi_scale(pil_image, preprocess.PRESETS[preset]), timings
+        # Evicted since the request loaded it; the decoded original is still at hand
+    image, scale, timings = preprocess.run(pil_image, preset)
+    return image, f"{image_hash}-{preset}", scale, timings
+
+def scale_zone(zone: Zone, scale: float) -> Zone:
+    if scale == 1.0:
+        return zone
+    return Zone(**{
+        **zone.dict(),
+        "x": round(zone.x * scale),
+        "y": round(zone.y * scale),
+        "width": round(zone.width * scale),
+        "height": round(zone.height * scale),
+    })
+
+async def load_test_request(zones, image, page_id, profile, languages, preset, table=None):
+    """Parse the shared /ocr/test form fields.
+
+    Returns (zone list, image, image hash, lang, preset, item table).
+    """
+    zone_list = [Zone(**z) for z in json.loads(zones)]
+    # Explicit form values win over the profile's settings
+    settings = load_profile_settings(profile) if profile else {}
+    lang = languages or settings.get("languages", OCR_LANG)
+    preset = preset or settings.get("preprocess", preprocess.DEFAULT_PRESET)
+    if preset not in preprocess.PRESETS:
+        raise HTTPException(status_code=400, detail=f"Unknown preprocess preset '{preset}'")
+    if table is not None:
         try:
-            value = pytesseract.image_to_string(cropped, lang='ces+eng+deu+pol').strip()
-            if not value or value == "NaN":
-                # Fallback to digit-only mode
-                value = pytesseract.image_to_string(
-                    cropped,
-                    lang='eng',  # You can skip lang or use 'eng' for numerals
-                    config='--psm 7 -c tessedit_char_whitelist=0123456789,.-'
-                ).strip()
-            success = True if value else False
-        except Exception as e:
-            print(f"[OCR] Error processing zone {zone.id}: {e}")
-            value = "NaN"
-            success = False
-        print(f"[OCR] Zone {zone.id} ({zone.propertyName}): '{value}'")
-        results.append(OCRResult(propertyName=zone.propertyName, text=value if value else "NaN", success=success))
+            table = json.loads(table)
+            item_table.validate(table)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid itemTable: {e}")
+    else:
+        table = settings.get("itemTable")
+
+    if page_id is not None:
+        # Page uploaded earlier through POST /ocr/pages
+        pil_image = page_cache.get(page_id)
+        if pil_image is None:
+            raise HTTPException(status_code=404, detail="Page not found or expired, upload it again")
+        image_hash = page_id
+    elif image is not None:
+        image_bytes = await image.read()
+        image_hash = ocr_cache.content_hash(image_bytes)
+        pil_image = Image.open(io.BytesIO(image_bytes))
+        pil_image.load()
+    else:
+        raise HTTPException(status_code=400, detail="Either image or page_id is required")
+    return zone_list, pil_image, image_hash, lang, preset, table
+
+@router.post("/test")
+async def ocr_test(
+    zones: str = Form(...),
+    image: Optional[UploadFile] = File(None),
+    page_id: Optional[str] = Form(None),
+    mode: str = Form("zone"),
+    profile: Optional[str] = Form(None),
+    languages: Optional[str] = Form(None),
+    preset: Optional[str] = Form(None, alias="preprocess"),
+    table: Optional[str] = Form(None, alias="itemTable")
+):
+    zone_list, pil_image, image_hash, lang, preset, table = await load_test_request(
+        zones, image, page_id, profile, languages, preset, table)
+
+    def run():
+        page, page_hash, scale, timings = prepare_page(pil_image, image_hash, preset, page_id)
+        scaled = [scale_zone(zone, scale) for zone in zone_list]
+        items = ocr_items(page, item_table.scale_table(table, scale), page_hash, lang) if table else None
+        if mode == "page":
+            return ocr_page(page, scaled, page_hash, lang), items, timings
+        return [ocr_zone(page, zone, page_hash, lang) for zone in scaled], items, timings
+
+    # OCR is blocking, keep it off the event loop
+    results, items, timings = await run_in_threadpool(run)
 
     print("[OCR] Test OCR completed for all zones.")
-    return {"results": [r.dict() for r in results]}
+    response = {
+        "results": [r.dict() for r in results],
+        "preprocess": {"preset": preset, "timings": timings}
+    }
+    if items is not None:
+        response["invoiceItems"] = items
+    return response
+
+@router.post("/test/stream")
+async def ocr_test_stream(
+    zones: str = Form(...),
+    image: Optional[UploadFile] = File(None),
+    page_id: Optional[str] = Form(None),
+    mode: str = Form("zone"),
+    profile: Optional[str] = Form(None),
+    languages: Optional[str] = Form(None),
+    preset: Optional[str] = Form(None, alias="preprocess"),
+    table: Optional[str] = Form(None, alias="itemTable"),
+    format: str = Form("ndjson")
+):
+    """Like /ocr/test, but zones run concurrently and each result is sent as soon as it is ready.
+
+    Records are {"type": "result", "zoneId", ...OCRResult}, then
+    {"type": "items"} when an item table is configured, and finally one
+    {"type": "summary"} record with timings. format=sse wraps them as
+    server-sent events.
+    """
+    zone_list, pil_image, image_hash, lang, preset, table = await load_test_request(
+        zones, image, page_id, profile, languages, preset, table)
+
+    def encode(record: dict) -> str:
+        data = json.dumps(record, ensure_ascii=False)
+        return f"data: {data}\n\n" if format == "sse" else f"{data}\n"
+
+    async def generate():
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        page, page_hash, scale, timings = await loop.run_in_executor(
+            _zone_executor, prepare_page, pil_image, image_hash, preset, page_id)
+        scaled = [scale_zone(zone, scale) for zone in zone_list]
+
+        words = None
+        if mode == "page":
+            words = await loop.run_in_executor(_zone_executor, safe_page_words, page, page_hash, lang)
+
+        def run_zone(zone):
+            if words is not None:
+                return zone, ocr_zone_from_words(page, zone, words, page_hash, lang)
+            return zone, ocr_zone(page, zone, page_hash, lang)
+
+        first_ms = None
+        tasks = [loop.run_in_executor(_zone_executor, run_zone, zone) for zone in scaled]
+        for next_done in asyncio.as_completed(tasks):
+            zone, result = await next_done
+            if first_ms is None:
+                first_ms = round((time.perf_counter() - started) * 1000, 1)
+            yield encode({"type": "result", "zoneId": zone.id, **result.dict()})
+
+        if table:
+            items = await loop.run_in_executor(
+                _zone_executor, ocr_items, page, item_table.scale_table(table, scale), page_hash, lang)
+            yield encode({"type": "items", "invoiceItems": items})
+
+        print("[OCR] Streamed OCR completed for all zones.")
+        yield encode({
+            "type": "summary",
+            "count": len(scaled),
+            "firstResultMs": first_ms,
+            "totalMs": round((time.perf_counter() - started) * 1000, 1),
+            "preprocess": {"preset": preset, "timings": timings}
+        })
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(generate(), media_type=media_type)
+
+@router.post("/pages")
+async def upload_page(image: UploadFile = File(...)):
+    image_bytes = await image.read()
+    try:
+        page_id = page_cache.put(image_bytes)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Cannot decode image: {e}")
+    pil_image = page_cache.get(page_id)
+    return {"page_id": page_id, "width": pil_image.width, "height": pil_image.height}
+
+@router.get("/pages")
+def page_cache_status():
+    return page_cache.stats()
+
+@router.delete("/pages/{page_id}")
+def delete_page(page_id: str):
+    if not page_cache.remove(page_id):
+        raise HTTPException(status_code=404, detail="Page not found")
+    return {"status": "deleted"}
+
+@router.get("/engine")
+def ocr_engine_status():
+    return ocr_engine.engine_stats()
+
+@router.get("/cascade")
+def ocr_cascade_status():
+    """How many zones each cascade tier settled, for tuning CASCADE_MIN_CONF."""
+    with _cascade_lock:
+        return {"min_confidence": CASCADE_MIN_CONF, "zones": _cascade_stats["zones"],
+                "tiers": dict(_cascade_stats["tiers"])}
+
+@router.get("/cache")
+def ocr_cache_status():
+    return ocr_cache.stats()
+
+@router.delete("/cache")
+def invalidate_ocr_cache(image_hash: Optional[str] = None):
+    if image_hash is not None and not re.fullmatch(r"[0-9a-f]{64}", image_hash):
+        raise HTTPException(status_code=400, detail="Invalid image hash")
+    removed = ocr_cache.invalidate(image_hash)
+    return {"status": "ok", "removed": removed}
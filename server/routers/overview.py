@@ -1,23 +1,23 @@
-from fastapi import APIRouter, HTTPException, Body, Query
+from fastapi import APIRouter, HTTPException, Body, Header, Query
 from pydantic import BaseModel
 from typing import List, Optional
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse
 import os
-import json
-import uuid
 import xml.etree.ElementTree as ET
 import base64
+import hashlib
 import mimetypes
-import re
+
+import overview_store
+import storage
+import xml_cache
 
 router = APIRouter()
 
 NUMERIC_TAGS = {
     "sumCelkem", "osv", "sumCelkem_r1", "sumCelkem_r2", "total_value", "mnozMj", "cenaMj"
 }
-
-overview_path = "data/overview"
-os.makedirs(overview_path, exist_ok=True)
+ATTACHMENT_CHUNK = 3 * 256 * 1024  # bytes of image per base64 chunk, a multiple of 3
 
 class OverviewInvoice(BaseModel):
     id: str
@@ -35,78 +35,89 @@ class OverviewInvoice(BaseModel):
 
 @router.post("/overview/add_batch")
 def add_batch(invoices: List[OverviewInvoice]):
-    for inv in invoices:
-        file_path = os.path.join(overview_path, f"{inv.id}.json")
-        with open(file_path, 'w') as f:
-            json.dump(inv.dict(), f)
+    overview_store.put_many([inv.dict() for inv in invoices])
     return {"status": "Batch added", "count": len(invoices)}
 
 @router.post("/overview/save_invoice")
-def save_invoice(invoice: dict):
+def save_invoice(invoice: dict, response: Response, if_match: Optional[str] = Header(None)):
     uid = invoice.get("id")
     if not uid:
         raise HTTPException(status_code=400, detail="Missing invoice ID")
 
-    path = os.path.join("data/overview", f"{uid}.json")
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(invoice, f, indent=2, ensure_ascii=False)
+    version = overview_store.put(invoice, if_match)
+    response.headers["ETag"] = overview_store.etag(version)
     return {"status": "saved"}
 
 @router.get("/overview/get_invoice")
-def get_invoice(id: str = Query(...)):
-    path = f"data/overview/{id}.json"
-    if not os.path.exists(path):
+def get_invoice(response: Response, id: str = Query(...)):
+    invoice, version = overview_store.get(id)
+    if invoice is None:
         raise HTTPException(status_code=404, detail="Invoice not found")
 
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    response.headers["ETag"] = overview_store.etag(version)
+    return invoice
 
 @router.delete("/overview/delete/{id}")
-def delete_invoice(id: str):
-    file_path = os.path.join(overview_path, f"{id}.json")
-
-    if not os.path.exists(file_path):
+def delete_invoice(id: str, if_match: Optional[str] = Header(None)):
+    if not overview_store.delete(id, if_match):
         raise HTTPException(status_code=404, detail="Invoice not found")
-
-    os.remove(file_path)
     return {"status": "deleted"}
 
 @router.delete("/overview/delete_all")
 def delete_all_invoices():
-    if not os.path.exists(overview_path):
+    if not overview_store.clear():
         return {"status": "already empty"}
-
-    for filename in os.listdir(overview_path):
-        if filename.endswith(".json"):
-            os.remove(os.path.join(overview_path, filename))
-
     return {"status": "cleared"}
 
 @router.get("/overview/list_invoices", response_model=List[OverviewInvoice])
-def list_invoices():
+def list_invoices(
+    response: Response,
+    batch: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    template: Optional[str] = None,
+    company: Optional[str] = None,
+    selected: Optional[bool] = None,
+    sort: str = "order",
+    order: str = "asc",
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[str] = None
+):
+    """Overview invoices, all of them in overview order when no parameters are given.
+
+    date_from/date_to are ISO dates (inclusive). With limit, X-Next-Cursor
+    holds the cursor of the next page and is absent on the last one;
+    X-Total-Count is the number of invoices matching the filters.
+    """
+    if sort not in overview_store.SORT_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of {', '.join(overview_store.SORT_COLUMNS)}")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="order must be 'asc' or 'desc'")
+    try:
+        rows, total, next_cursor = overview_store.query(batch, date_from, date_to, template, company, selected,
+                                                        sort, order == "desc", limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
     invoices = []
-    for filename in os.listdir(overview_path):
-        if filename.endswith(".json"):
-            with open(os.path.join(overview_path, filename), 'r') as f:
-                data = json.load(f)
-                try:
-                    data.setdefault("systemValues", {})
-                    invoices.append(OverviewInvoice(**data))
-                except Exception as e:
-                    print(f"⚠️ Skipping {filename} due to error: {e}")
-    invoices.sort(key=lambda x: x.order)
+    for data in rows:
+        try:
+            data.setdefault("systemValues", {})
+            invoices.append(OverviewInvoice(**data))
+        except Exception as e:
+            print(f"⚠️ Skipping {data.get('id')} due to error: {e}")
+    response.headers["X-Total-Count"] = str(total)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return invoices
 
 @router.patch("/overview/update_invoice/{invoice_id}")
-def update_invoice(invoice_id: str, updated_fields: dict):
-    file_path = os.path.join(overview_path, f"{invoice_id}.json")
-    if not os.path.exists(file_path):
+def update_invoice(invoice_id: str, updated_fields: dict, response: Response,
+                   if_match: Optional[str] = Header(None)):
+    version = overview_store.update(invoice_id, updated_fields, if_match)
+    if version is None:
         raise HTTPException(status_code=404, detail="Invoice not found")
-    with open(file_path, 'r') as f:
-        data = json.load(f)
-    data.update(updated_fields)
-    with open(file_path, 'w') as f:
-        json.dump(data, f)
+    response.headers["ETag"] = overview_store.etag(version)
     return {"status": "Invoice updated"}
 
 class ExportRequest(BaseModel):
@@ -116,11 +127,9 @@ class ExportRequest(BaseModel):
 def export_selected(req: ExportRequest):
     root = ET.Element("Invoices")
     for invoice_id in req.ids:
-        file_path = os.path.join(overview_path, f"{invoice_id}.json")
-        if not os.path.exists(file_path):
+        data, _ = overview_store.get(invoice_id)
+        if data is None:
             continue
-        with open(file_path, 'r') as f:
-            data = json.load(f)
 
         inv_elem = ET.SubElement(root, "Invoice")
         ET.SubElement(inv_elem, "InvoiceNumber").text = data.get("invoice_number")
@@ -143,74 +152,134 @@ def clean_number(value: str) -> str:
     value = value.strip('"')                             # Remove surrounding quotes
     return value
 
-def sanitize_xml_tree(root: ET.Element):
-    for elem in root.iter():
-        tag = elem.tag.split("}")[-1]  # Remove namespace if any
-        if tag in NUMERIC_TAGS and elem.text:
-            elem.text = clean_number(elem.text)
-
-@router.post("/overview/export_flexibee")
-def export_flexibee(selected_ids: List[str] = Body(...)):
-    overview_dir = "data/overview"
-    winstrom = ET.Element("winstrom", attrib={"version": "1.0", "source": "OCRApp"})
-
+def _sub(parent: ET.Element, tag: str, value) -> ET.Element:
+    """Append a text element; numeric tags are cleaned as they are written."""
+    elem = ET.SubElement(parent, tag)
+    text = str(value)
+    elem.text = clean_number(text) if tag in NUMERIC_TAGS and text else text
+    return elem
+
+def _iter_attachment(image_path: str, filename_xml: str, content_type: str):
+    """Serialised <prilohy> with the image base64-encoded in chunks straight from disk."""
+    priloha = ET.Element("priloha")
+    ET.SubElement(priloha, "nazSoub").text = filename_xml
+    ET.SubElement(priloha, "contentType").text = content_type
+    head = b"".join(ET.tostring(child, encoding="utf-8") for child in priloha)
+    with open(image_path, "rb") as img_file:
+        chunk = img_file.read(ATTACHMENT_CHUNK)
+        if not chunk:
+            yield b"<prilohy><priloha>" + head + b'<content encoding="base64" /></priloha></prilohy>'
+            return
+        yield b"<prilohy><priloha>" + head + b'<content encoding="base64">'
+        # A multiple of 3 bytes encodes without padding, so the chunks concatenate
+        while chunk:
+            yield base64.b64encode(chunk)
+            chunk = img_file.read(ATTACHMENT_CHUNK)
+    yield b"</content></priloha></prilohy>"
+
+def iter_invoice_xml(invoice: dict):
+    """One <faktura-prijata> element as byte chunks; only the attachment is large."""
+    values = invoice.get("values", {})
+
+    dat_splat = values.get("datSplat", "").strip()
+    if not dat_splat or dat_splat == "0":
+        dat_vyst = values.get("datVyst")
+        if dat_vyst:
+            values["datSplat"] = dat_vyst
+
+    items = invoice.get("invoiceItems", [])
+    template = invoice.get("template_used", "default")
+    invoice_number = invoice.get("invoice_number", "unknown")
+    image_filename = invoice.get("imageFilename")
+
+    faktura = ET.Element("faktura-prijata")
+
+    for key, value in values.items():
+        _sub(faktura, key, value)
+
+    polozky = ET.SubElement(faktura, "polozkyFaktury")
+    for item in items:
+        polozka = ET.SubElement(polozky, "faktura-prijata-polozka")
+        for k, v in item.items():
+            _sub(polozka, k, v)
+
+    osv_value = values.get("osv")
+    if osv_value:
+        zaokrouhli = ET.SubElement(faktura, "zaokrouhli")
+        ceny = ET.SubElement(zaokrouhli, "pozadovaneCeny")
+        _sub(ceny, "osv", osv_value)
+
+    # Everything but the attachment is small; it goes out before the closing tag
+    closing = b"</faktura-prijata>"
+    body = ET.tostring(faktura, encoding="utf-8", method="xml")
+    yield body[:-len(closing)]
+
+    if image_filename:
+        queue_dir = f"data/queues/{invoice.get('batch_name')}"
+        image_path = os.path.join(queue_dir, image_filename)
+        if os.path.exists(image_path):
+            ext = os.path.splitext(image_filename)[1].lower()
+            content_type = mimetypes.types_map.get(ext, "image/png")
+            filename_xml = f"{invoice_number}_{template}{ext}"
+            yield from _iter_attachment(image_path, filename_xml, content_type)
+
+    yield closing
+
+def _attachment_hash(invoice: dict, queue_blobs: dict) -> str:
+    """sha256 of the invoice's scan, "" when it has none.
+
+    Queues record the blob hash of every page; older queues without one have
+    the file hashed. queue_blobs caches each queue's blob map for one export.
+    """
+    image_filename = invoice.get("imageFilename")
+    if not image_filename:
+        return ""
+    queue_dir = f"data/queues/{invoice.get('batch_name')}"
+    image_path = os.path.join(queue_dir, image_filename)
+    if not os.path.exists(image_path):
+        return ""
+    if queue_dir not in queue_blobs:
+        meta_path = os.path.join(queue_dir, "meta.json")
+        try:
+            queue_blobs[queue_dir] = storage.read_json(meta_path).get("blobs", {})
+        except (OSError, ValueError):
+            queue_blobs[queue_dir] = {}
+    sha = queue_blobs[queue_dir].get(image_filename)
+    if sha:
+        return sha
+    digest = hashlib.sha256()
+    with open(image_path, "rb") as f:
+        while chunk := f.read(ATTACHMENT_CHUNK):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def iter_flexibee_xml(selected_ids: List[str], progress=None):
+    """The FlexiBee winstrom XML as byte chunks, one invoice at a time.
+
+    Memory use does not grow with the number of invoices or the size of their
+    scans. Invoices exported before and unchanged since are copied from the
+    fragment cache. progress() is called once per invoice.
+    """
+    queue_blobs = {}
+    yield b'<winstrom version="1.0" source="OCRApp">'
     for uid in selected_ids:
-        path = os.path.join(overview_dir, f"{uid}.json")
-        if not os.path.exists(path):
+        if progress is not None:
+            progress()
+        invoice, _ = overview_store.get(uid)
+        if invoice is None:
             continue
+        cache_key = xml_cache.key(invoice, _attachment_hash(invoice, queue_blobs))
+        yield from xml_cache.iter_fragment(cache_key, lambda: iter_invoice_xml(invoice))
+    yield b"</winstrom>"
+
+@router.get("/overview/export-cache")
+def get_export_cache_stats():
+    return xml_cache.stats()
 
-        with open(path, "r", encoding="utf-8") as f:
-            invoice = json.load(f)
-
-        values = invoice.get("values", {})
-
-        dat_splat = values.get("datSplat", "").strip()
-        if not dat_splat or dat_splat == "0":
-            dat_vyst = values.get("datVyst")
-            if dat_vyst:
-                values["datSplat"] = dat_vyst
-
-        items = invoice.get("invoiceItems", [])
-        template = invoice.get("template_used", "default")
-        invoice_number = invoice.get("invoice_number", "unknown")
-        image_filename = invoice.get("imageFilename")
-
-        faktura = ET.SubElement(winstrom, "faktura-prijata")
-
-        for key, value in values.items():
-            ET.SubElement(faktura, key).text = str(value)
-
-        polozky = ET.SubElement(faktura, "polozkyFaktury")
-        for item in items:
-            polozka = ET.SubElement(polozky, "faktura-prijata-polozka")
-            for k, v in item.items():
-                ET.SubElement(polozka, k).text = str(v)
-
-        osv_value = values.get("osv")
-        if osv_value:
-            zaokrouhli = ET.SubElement(faktura, "zaokrouhli")
-            ceny = ET.SubElement(zaokrouhli, "pozadovaneCeny")
-            ET.SubElement(ceny, "osv").text = str(osv_value)
-
-        if image_filename:
-            queue_dir = f"data/queues/{invoice.get('batch_name')}"
-            image_path = os.path.join(queue_dir, image_filename)
-            if os.path.exists(image_path):
-                with open(image_path, "rb") as img_file:
-                    encoded = base64.b64encode(img_file.read()).decode("utf-8")
-                ext = os.path.splitext(image_filename)[1].lower()
-                content_type = mimetypes.types_map.get(ext, "image/png")
-                filename_xml = f"{invoice_number}_{template}{ext}"
-
-                prilohy = ET.SubElement(faktura, "prilohy")
-                priloha = ET.SubElement(prilohy, "priloha")
-                ET.SubElement(priloha, "nazSoub").text = filename_xml
-                ET.SubElement(priloha, "contentType").text = content_type
-                ET.SubElement(priloha, "content", attrib={"encoding": "base64"}).text = encoded
-
-    # 🧼 Sanitize numeric values in-place in XML tree
-    sanitize_xml_tree(winstrom)
-
-    # Export as string
-    xml_str = ET.tostring(winstrom, encoding="utf-8", method="xml")
-    return Response(content=xml_str, media_type="application/xml")
\ No newline at end of file
+@router.post("/overview/export-cache/clear")
+def clear_export_cache():
+    return {"removed": xml_cache.clear()}
+
+@router.post("/overview/export_flexibee")
+def export_flexibee(selected_ids: List[str] = Body(...)):
+    return StreamingResponse(iter_flexibee_xml(selected_ids), media_type="application/xml")
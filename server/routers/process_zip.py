@@ -1,74 +1,356 @@
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+import asyncio
 import os
 import zipfile
 import shutil
 import uuid
 from pathlib import Path
+from typing import Optional
 import json
 
+import batch_ocr
+import image_cache
+import janitor
+import page_index
+import page_source
+import profile_registry
+
 router = APIRouter()
 
-TEMP_DIR = "temp_batches"
-PROFILE_DIR = "data/profiles"
+TEMP_DIR = janitor.TEMP_DIR
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# Members accepted from an archive: single images and multi-page containers
+PAGE_EXTENSIONS = IMAGE_EXTENSIONS + page_source.CONTAINER_EXTENSIONS
+
+# Ingestion limits, checked while the upload is spooled and before extraction
+MAX_ZIP_BYTES = int(os.environ.get("ZIP_MAX_MB", 4096)) * 1024 * 1024
+MAX_UNCOMPRESSED_BYTES = int(os.environ.get("ZIP_MAX_UNCOMPRESSED_MB", 8192)) * 1024 * 1024
+MAX_MEMBERS = int(os.environ.get("ZIP_MAX_MEMBERS", 5000))
+CHUNK_SIZE = 1024 * 1024
 
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+def list_batch_images(batch_dir: str):
+    """Page filenames of a batch; container pages are listed without decoding them."""
+    pages = []
+    for f in os.listdir(batch_dir):
+        if page_source.is_container(f):
+            pages.extend(page_source.container_pages(os.path.join(batch_dir, f)))
+        elif f.lower().endswith(IMAGE_EXTENSIONS) and page_source.parse_virtual(f) is None:
+            pages.append(f)
+    return sorted(pages)
+
+def spool_upload(upload: UploadFile, path: str):
+    """Copy the upload to disk in chunks, enforcing MAX_ZIP_BYTES."""
+    upload.file.seek(0)
+    written = 0
+    with open(path, "wb") as f:
+        while True:
+            chunk = upload.file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            written += len(chunk)
+            if written > MAX_ZIP_BYTES:
+                raise HTTPException(status_code=413, detail="ZIP file too large")
+            f.write(chunk)
+
+def image_members(zip_ref: zipfile.ZipFile):
+    """Page members of the archive (subfolders included), validated against the limits."""
+    infos = zip_ref.infolist()
+    if len(infos) > MAX_MEMBERS:
+        raise HTTPException(status_code=413, detail=f"ZIP has more than {MAX_MEMBERS} members")
+    members = [
+        info for info in infos
+        if not info.is_dir()
+        and info.filename.lower().endswith(PAGE_EXTENSIONS)
+        and not os.path.basename(info.filename).startswith(".")
+        and not info.filename.startswith("__MACOSX/")
+    ]
+    if sum(info.file_size for info in members) > MAX_UNCOMPRESSED_BYTES:
+        raise HTTPException(status_code=413, detail="ZIP content too large")
+    return members
+
+def member_filename(name: str, taken: set) -> str:
+    """Flatten a member path (sub/dir/a.png -> sub__dir__a.png) into a unique filename."""
+    parts = [p for p in name.replace("\\", "/").split("/") if p not in ("", ".", "..")]
+    filename = "__".join(parts)
+    stem, ext = os.path.splitext(filename)
+    n = 1
+    while filename in taken:
+        filename = f"{stem}_{n}{ext}"
+        n += 1
+    taken.add(filename)
+    return filename
+
+def add_container(batch_dir: str, filename: str, on_page):
+    """Announce the pages of a PDF/TIFF; they are rasterised later, on first use."""
+    try:
+        pages = page_source.container_pages(os.path.join(batch_dir, filename))
+    except Exception as e:
+        print(f"[ZIP] Cannot read pages of {filename}: {e}")
+        return
+    for page in pages:
+        on_page(page)
+
+def extract_images(zip_path: str, batch_dir: str, on_page):
+    """Extract page members one by one, calling on_page(filename) as each page is available."""
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        taken = set()
+        for info in image_members(zip_ref):
+            filename = member_filename(info.filename, taken)
+            with zip_ref.open(info) as src, open(os.path.join(batch_dir, filename), "wb") as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            if page_source.is_container(filename):
+                add_container(batch_dir, filename, on_page)
+            else:
+                on_page(filename)
+
+def make_page(batch_id: str, filename: str, profile_data: profile_registry.Profile) -> dict:
+    return {
+        "filename": filename,
+        "imageUrl": f"/temp/{batch_id}/{filename}",
+        "zones": profile_data.zone_dicts(),
+        "values": {}
+    }
+
+def apply_ocr_result(page: dict, result: dict):
+    page["values"] = result["values"]
+    page["confidence"] = result["confidence"]
+    page["ocrTimedOut"] = result["timedOut"]
+    if "invoiceItems" in result:
+        page["invoiceItems"] = result["invoiceItems"]
+    if "error" in result:
+        page["ocrError"] = result["error"]
+
+def index_page(batch_dir: str, page: dict, profile: str, rasterise: bool = False):
+    """Flag a page whose exact content was seen before and add it to the page index.
+
+    Values of an identical earlier page are taken over so the page needs no
+    OCR. A near match is not flagged yet: ocr_batch_pages() reports it in
+    duplicateOf only when OCR reads the same values. Returns (sha, dHash,
+    near match or None), or None for a container page that is not
+    rasterised yet.
+    """
+    path = os.path.join(batch_dir, page["filename"])
+    if rasterise:
+        page_source.ensure_page(path)
+    if not os.path.exists(path):
+        return None
+    try:
+        sha, phash = page_index.fingerprint(path)
+    except Exception as e:
+        print(f"[ZIP] Cannot fingerprint {page['filename']}: {e}")
+        return None
+
+    values = None
+    match = page_index.find(sha, phash)
+    if match is not None and match["sha"] != sha:
+        near, match = match, None
+    else:
+        near = None
+    if match is not None:
+        page["duplicateOf"] = page_index.describe(match, sha)
+        values = page_index.reusable_values(match, sha, profile)
+        if values is not None:
+            page["values"] = dict(values)
+            page["duplicateOf"]["reusedValues"] = True
+    ref = {"source": "batch", "batchId": os.path.basename(batch_dir), "filename": page["filename"]}
+    page_index.add(sha, phash, ref, profile, values)
+    return sha, phash, near
+
+def index_pages(batch_dir: str, pages: list, profile: str, rasterise: bool = False) -> dict:
+    fingerprints = {}
+    for page in pages:
+        fingerprint = index_page(batch_dir, page, profile, rasterise)
+        if fingerprint is not None:
+            fingerprints[page["filename"]] = fingerprint
+    return fingerprints
+
+async def ocr_batch_pages(batch_dir: str, pages: list, profile_data: profile_registry.Profile,
+                          fingerprints: Optional[dict] = None):
+    """Pre-fill values on the server instead of one /ocr/test call per page.
+
+    Pages that took over the values of a duplicate are skipped; fresh results
+    are stored in the page index for later copies, and a near match read
+    with the same values is reported in duplicateOf.
+    """
+    pages = [p for p in pages if not p.get("duplicateOf", {}).get("reusedValues")]
+    settings = profile_data.settings
+    ocr_results = await batch_ocr.ocr_pages(
+        [os.path.join(batch_dir, page["filename"]) for page in pages],
+        profile_data.zone_dicts(),
+        settings["languages"],
+        settings["preprocess"],
+        table=settings["itemTable"]
+    )
+    for page, result in zip(pages, ocr_results):
+        apply_ocr_result(page, result)
+        fingerprint = (fingerprints or {}).get(page["filename"])
+        if fingerprint is not None and result["values"] and not result["timedOut"]:
+            sha, phash, near = fingerprint
+            if near is not None and page_index.confirms(near, sha, profile_data.name, result["values"]):
+                page["duplicateOf"] = page_index.describe(near, sha)
+            ref = {"source": "batch", "batchId": os.path.basename(batch_dir), "filename": page["filename"]}
+            page_index.add(sha, phash, ref, profile_data.name, result["values"])
+
 @router.post("/process-zip")
-async def process_zip(zip: UploadFile = File(...), profile: str = Form(...)):
+async def process_zip(
+    zip: UploadFile = File(...),
+    profile: str = Form(...),
+    ocr: bool = Form(False),
+    stream: bool = Form(False)
+):
     # Check profile exists
-    profile_path = os.path.join(PROFILE_DIR, profile)
-    config_path = os.path.join(profile_path, "config.json")
-    if not os.path.exists(config_path):
+    profile_data = profile_registry.get(profile)
+    if profile_data is None:
         raise HTTPException(status_code=404, detail="Profile not found")
 
-    with open(config_path, "r", encoding="utf-8") as f:
-        config = json.load(f)
-
     # Create unique temp folder
     batch_id = str(uuid.uuid4())
     batch_dir = os.path.join(TEMP_DIR, batch_id)
     os.makedirs(batch_dir, exist_ok=True)
 
-    # Extract ZIP
-    zip_path = os.path.join(batch_dir, zip.filename)
-    with open(zip_path, "wb") as f:
-        content = await zip.read()
-        f.write(content)
+    # Container pages are rasterised lazily at the profile's DPI
+    page_source.write_batch_meta(batch_dir, profile=profile, dpi=profile_data.settings["dpi"])
 
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall(batch_dir)
+    # A PDF or TIFF may be uploaded directly instead of inside a ZIP
+    upload_name = os.path.basename(zip.filename or "")
+    if page_source.is_container(upload_name):
+        filenames = []
+        try:
+            await run_in_threadpool(spool_upload, zip, os.path.join(batch_dir, upload_name))
+            await run_in_threadpool(add_container, batch_dir, upload_name, filenames.append)
+        except HTTPException:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+            raise
+        except Exception as e:
+            print(f"[ZIP] Reading batch {batch_id} failed: {e}")
+            shutil.rmtree(batch_dir, ignore_errors=True)
+            raise HTTPException(status_code=400, detail=f"Cannot read the uploaded file: {e}")
+        if not filenames:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+            raise HTTPException(status_code=400, detail="Cannot read pages of the uploaded file")
+        pages = [make_page(batch_id, filename, profile_data) for filename in filenames]
+        fingerprints = await run_in_threadpool(index_pages, batch_dir, pages, profile, ocr)
+        if ocr:
+            await ocr_batch_pages(batch_dir, pages, profile_data, fingerprints)
+        return {"pages": pages}
 
-    os.remove(zip_path)
+    # Spool the upload to disk and check the archive before extracting
+    zip_path = os.path.join(batch_dir, "upload.zip.part")
+    try:
+        await run_in_threadpool(spool_upload, zip, zip_path)
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            image_members(zip_ref)
+    except zipfile.BadZipFile:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        raise HTTPException(status_code=400, detail="Invalid ZIP file")
+    except HTTPException:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        raise
 
-    # Filter image files
-    image_files = sorted([
-        f for f in os.listdir(batch_dir)
-        if f.lower().endswith(('.jpg', '.jpeg', '.png'))
-    ])
+    if not stream:
+        filenames = []
+        try:
+            await run_in_threadpool(extract_images, zip_path, batch_dir, filenames.append)
+        except Exception as e:
+            print(f"[ZIP] Extraction of batch {batch_id} failed: {e}")
+            shutil.rmtree(batch_dir, ignore_errors=True)
+            raise HTTPException(status_code=400, detail=f"Cannot extract ZIP file: {e}")
+        finally:
+            if os.path.exists(zip_path):
+                os.remove(zip_path)
+        pages = [make_page(batch_id, filename, profile_data) for filename in sorted(filenames)]
+        fingerprints = await run_in_threadpool(index_pages, batch_dir, pages, profile, ocr)
+        if ocr and pages:
+            await ocr_batch_pages(batch_dir, pages, profile_data, fingerprints)
+        return {"pages": pages}
 
-    pages = []
-    for filename in image_files:
-        image_url = f"/temp/{batch_id}/{filename}"
-        zones = config.copy()
-        for zone in zones:
-            zone["x"] = int(zone["x"])
-            zone["y"] = int(zone["y"])
-            zone["width"] = int(zone["width"])
-            zone["height"] = int(zone["height"])
-        pages.append({
-            "filename": filename,
-            "imageUrl": image_url,
-            "zones": zones,
-            "values": {}
-        })
-
-    return {"pages": pages}
+    async def generate():
+        # NDJSON: one {"type": "page"} record per extracted image, optional
+        # {"type": "ocr"} records, then a final {"type": "summary"}
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        done = object()
+
+        def on_page(filename):
+            loop.call_soon_threadsafe(queue.put_nowait, filename)
+
+        def run():
+            try:
+                extract_images(zip_path, batch_dir, on_page)
+            finally:
+                os.remove(zip_path)
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+
+        extraction = loop.run_in_executor(None, run)
+        pages = []
+        fingerprints = {}
+        while True:
+            filename = await queue.get()
+            if filename is done:
+                break
+            page = make_page(batch_id, filename, profile_data)
+            fingerprint = await run_in_threadpool(index_page, batch_dir, page, profile, ocr)
+            if fingerprint is not None:
+                fingerprints[filename] = fingerprint
+            pages.append(page)
+            yield json.dumps({"type": "page", **page}, ensure_ascii=False) + "\n"
+
+        error = None
+        try:
+            await extraction
+        except Exception as e:
+            print(f"[ZIP] Extraction of batch {batch_id} failed: {e}")
+            error = str(e)
+
+        if ocr and pages and error is None:
+            await ocr_batch_pages(batch_dir, pages, profile_data, fingerprints)
+            for page in pages:
+                record = {k: v for k, v in page.items() if k not in ("zones", "imageUrl")}
+                yield json.dumps({"type": "ocr", **record}, ensure_ascii=False) + "\n"
+
+        yield json.dumps({"type": "summary", "batchId": batch_id, "count": len(pages), "error": error}) + "\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
 
 # Serve images from temp
 @router.get("/temp/{batch_id}/{filename}")
-def get_temp_image(batch_id: str, filename: str):
+def get_temp_image(request: Request, batch_id: str, filename: str, size: Optional[str] = None):
     path = os.path.join(TEMP_DIR, batch_id, filename)
-    if not os.path.exists(path):
+    if not page_source.ensure_page(path):
         raise HTTPException(status_code=404, detail="Image not found")
-    return FileResponse(path, media_type="image/jpeg")
+    janitor.touch(batch_id)
+    # Batch pages are never rewritten once extracted
+    return image_cache.serve_image(request, path, size, cache_control=image_cache.IMMUTABLE)
+
+# Temp batch housekeeping
+@router.get("/temp-batches/usage")
+def get_temp_usage():
+    return janitor.usage()
+
+@router.post("/temp-batches/collect")
+def collect_temp_batches():
+    removed = janitor.collect()
+    return {"expired": removed["ttl"], "evicted": removed["quota"],
+            "scratch": removed["scratch"], "freedBytes": removed["freedBytes"]}
+
+@router.post("/temp/{batch_id}/pin")
+def pin_batch(batch_id: str, pinned: bool = Form(True)):
+    """Keep a batch out of clean-up while its queue is being edited."""
+    if not os.path.isdir(os.path.join(TEMP_DIR, batch_id)):
+        raise HTTPException(status_code=404, detail="Batch not found")
+    janitor.pin(batch_id, pinned)
+    janitor.touch(batch_id)
+    return {"batchId": batch_id, "pinned": pinned}
+
+@router.get("/page-index")
+def get_page_index_stats():
+    return page_index.stats()
+
+@router.post("/page-index/rebuild")
+def rebuild_page_index():
+    """Re-fingerprint all pages in data/queues and temp_batches."""
+    return page_index.rebuild()
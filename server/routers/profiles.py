@@ -1,68 +1,55 @@
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Request
+from pydantic import ValidationError
 import os
+import re
 import json
 import shutil
-from datetime import datetime
 from typing import Optional
 
-router = APIRouter()
+from field_types import FIELD_TYPES
+from profile_registry import PROFILE_DIR, normalize_zone
+import image_cache
+import item_table
+import preprocess
+import profile_registry
+import storage
 
-PROFILE_DIR = "data/profiles"
-os.makedirs(PROFILE_DIR, exist_ok=True)
+router = APIRouter()
 
-class Zone(BaseModel):
-    id: int
-    x: int
-    y: int
-    width: int
-    height: int
-    propertyName: str
+def load_profile_settings(name: str) -> dict:
+    """Profile-level OCR settings stored next to config.json."""
+    return profile_registry.settings(name)
 
 @router.get("/")
 def list_profiles():
     profiles = []
-    for name in os.listdir(PROFILE_DIR):
-        path = os.path.join(PROFILE_DIR, name)
-        if os.path.isdir(path):
-            created = updated = None
-            config_path = os.path.join(path, "config.json")
-            if os.path.exists(config_path):
-                ts = os.path.getctime(config_path)
-                created = datetime.fromtimestamp(ts).isoformat()
-                ts = os.path.getmtime(config_path)
-                updated = datetime.fromtimestamp(ts).isoformat()
-            profiles.append({
-                "name": name,
-                "created": created,
-                "updated": updated
-            })
+    for name in profile_registry.names():
+        info = profile_registry.info(name)
+        profiles.append({
+            "name": name,
+            "created": info["created"] if info else None,
+            "updated": info["updated"] if info else None
+        })
     return profiles
 
 @router.get("/{name}")
 def get_profile(name: str):
-    profile_path = os.path.join(PROFILE_DIR, name)
-    config_path = os.path.join(profile_path, "config.json")
-    image_path = os.path.join(profile_path, "preview.jpg")
-
-    if not os.path.exists(config_path):
+    profile = profile_registry.get(name)
+    if profile is None:
         raise HTTPException(status_code=404, detail="Profile config not found")
 
-    with open(config_path, "r", encoding="utf-8") as f:
-        config = json.load(f)
-
     return {
-        "zones": config,
-        "image_url": f"/profiles/{name}/preview.jpg"
+        "zones": profile.config,
+        "image_url": f"/profiles/{name}/preview.jpg",
+        **profile.settings
     }
 
 @router.get("/{name}/preview.jpg")
-def get_profile_image(name: str):
+def get_profile_image(request: Request, name: str, size: Optional[str] = None):
     image_path = os.path.join(PROFILE_DIR, name, "preview.jpg")
     if not os.path.exists(image_path):
         raise HTTPException(status_code=404, detail="Image not found")
-    return FileResponse(image_path, media_type="image/jpeg")
+    return image_cache.serve_image(request, image_path, size)
 
 @router.delete("/{name}")
 def delete_profile(name: str):
@@ -70,30 +57,68 @@ def delete_profile(name: str):
     if not os.path.exists(profile_path):
         raise HTTPException(status_code=404, detail="Profile not found")
     shutil.rmtree(profile_path)
+    profile_registry.invalidate(name)
     return {"status": "ok", "message": f"Profile '{name}' deleted."}
 
 @router.post("/")
 async def save_profile(
     name: str = Form(...),
     zones: str = Form(...),
-    image: Optional[UploadFile] = File(None)
+    image: Optional[UploadFile] = File(None),
+    languages: Optional[str] = Form(None),
+    preprocess_preset: Optional[str] = Form(None, alias="preprocess"),
+    items: Optional[str] = Form(None, alias="itemTable"),
+    dpi: Optional[int] = Form(None)
 ):
+    if languages is not None and not re.fullmatch(r"[a-z_]+(\+[a-z_]+)*", languages):
+        raise HTTPException(status_code=400, detail="Invalid languages, expected e.g. 'ces+eng'")
+    if preprocess_preset is not None and preprocess_preset not in preprocess.PRESETS:
+        raise HTTPException(status_code=400, detail=f"Unknown preprocess preset '{preprocess_preset}'")
+    if dpi is not None and not 72 <= dpi <= 1200:
+        raise HTTPException(status_code=400, detail="dpi must be between 72 and 1200")
+    table = None
+    if items:
+        try:
+            table = json.loads(items)
+            item_table.validate(table)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid itemTable: {e}")
+
     profile_path = os.path.join(PROFILE_DIR, name)
     os.makedirs(profile_path, exist_ok=True)
 
     # Save image if provided
     if image is not None:
-        image_path = os.path.join(profile_path, "preview.jpg")
-        with open(image_path, "wb") as f:
-            content = await image.read()
-            f.write(content)
+        storage.write_bytes(os.path.join(profile_path, "preview.jpg"), await image.read())
 
     # Save config.json
     try:
         zone_list = json.loads(zones)
-        with open(os.path.join(profile_path, "config.json"), "w", encoding="utf-8") as f:
-            json.dump(zone_list, f, indent=2, ensure_ascii=False)
     except json.JSONDecodeError:
         raise HTTPException(status_code=400, detail="Invalid JSON in zones")
+    for zone in zone_list:
+        try:
+            field_type = normalize_zone(zone).fieldType
+        except (TypeError, ValueError, ValidationError) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid zone: {e}")
+        if field_type is not None and field_type not in FIELD_TYPES:
+            raise HTTPException(status_code=400, detail=f"Unknown fieldType '{field_type}'")
+    # Written atomically: other workers may be loading the profile right now
+    storage.write_json(os.path.join(profile_path, "config.json"), zone_list, indent=2, ensure_ascii=False)
+
+    # Save settings.json
+    if any(v is not None for v in (languages, preprocess_preset, items, dpi)):
+        settings = load_profile_settings(name)
+        if languages is not None:
+            settings["languages"] = languages
+        if preprocess_preset is not None:
+            settings["preprocess"] = preprocess_preset
+        if items is not None:
+            # An empty itemTable field removes the table
+            settings["itemTable"] = table
+        if dpi is not None:
+            settings["dpi"] = dpi
+        storage.write_json(os.path.join(profile_path, "settings.json"), settings, indent=2, ensure_ascii=False)
 
+    profile_registry.invalidate(name)
     return {"status": "ok", "message": f"Profile '{name}' saved."}
\ No newline at end of file
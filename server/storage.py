@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+
+from fastapi import HTTPException
+
+try:
+    import fcntl
+except ImportError:  # Windows: locks only cover threads of one process
+    fcntl = None
+
+# Storage helpers that make the JSON files safe to share between several
+# uvicorn workers:
+#   - writes go to a temp file in the same folder and are renamed into place,
+#     so readers never see a half-written file;
+#   - locked(path) serialises read-modify-write cycles on one resource across
+#     threads and processes. Resources are hashed onto LOCK_STRIPES stripes
+#     per lock group, each a thread lock plus a flock on a lock file under
+#     LOCK_DIR, so the number of lock files stays fixed however many
+#     resources are locked. Locks of one group are never nested; a resource
+#     locked while another is held (a blob inside a queue save) uses its own
+#     group, so two stripes can never be taken in opposite orders;
+#   - version(path) is a tag that changes on every write; handlers return it
+#     as ETag and reject writes whose If-Match no longer matches with 412.
+LOCK_DIR = "data/locks"
+LOCK_STRIPES = 64
+
+os.makedirs(LOCK_DIR, exist_ok=True)
+
+_stripes_guard = threading.Lock()
+_stripes = {}  # lock group -> LOCK_STRIPES thread locks
+_held = threading.local()  # stripes held by the current thread
+
+
+def _remove_legacy_locks():
+    """Drop the per-resource <sha1>.lock files written before locks were striped."""
+    for name in os.listdir(LOCK_DIR):
+        if len(name) == 45 and name.endswith(".lock") and "." not in name[:-5]:
+            try:
+                os.remove(os.path.join(LOCK_DIR, name))
+            except FileNotFoundError:
+                pass
+
+
+_remove_legacy_locks()
+
+
+def temp_path(path: str) -> str:
+    """A unique hidden temp file next to path, to be renamed over it when complete."""
+    return os.path.join(os.path.dirname(path) or ".", f".{os.path.basename(path)}.{uuid.uuid4().hex}.tmp")
+
+
+@contextmanager
+def open_atomic(path: str, fsync: bool = True):
+    """Binary file to write in steps; it replaces path only if the block completes.
+
+    Caches that can rebuild a lost file pass fsync=False.
+    """
+    tmp_path = temp_path(path)
+    try:
+        with open(tmp_path, "wb") as f:
+            yield f
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_bytes(path: str, data: bytes, fsync: bool = True):
+    with open_atomic(path, fsync=fsync) as f:
+        f.write(data)
+
+
+def write_json(path: str, data, fsync: bool = True, **dump_kwargs):
+    """Atomically replace path with data serialised as JSON (json.dump keyword arguments apply)."""
+    write_bytes(path, json.dumps(data, **dump_kwargs).encode("utf-8"), fsync=fsync)
+
+
+def read_json(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _stripe_lock(group: str, stripe: int) -> threading.Lock:
+    with _stripes_guard:
+        if group not in _stripes:
+            _stripes[group] = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        return _stripes[group][stripe]
+
+
+@contextmanager
+def locked(path: str, group: str = "files"):
+    """Hold an exclusive lock on one resource (file or folder) for a read-modify-write.
+
+    Re-entrant: a thread that already holds the resource's stripe passes
+    straight through.
+    """
+    digest = hashlib.sha1(os.path.abspath(path).encode("utf-8")).digest()
+    stripe = int.from_bytes(digest[:4], "big") % LOCK_STRIPES
+    key = f"{group}.{stripe}"
+    held = _held.__dict__.setdefault("keys", set())
+    if key in held:
+        yield
+        return
+    with _stripe_lock(group, stripe):
+        held.add(key)
+        try:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(LOCK_DIR, f"{key}.lock"), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            held.discard(key)
+
+
+def version(path: str) -> Optional[str]:
+    """ETag of the file's current version; atomic writes always give a new inode."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def check_etag(current: Optional[str], if_match: Optional[str]):
+    """Raise 412 unless if_match is absent, "*" or lists the current ETag."""
+    if if_match is None or if_match.strip() == "*":
+        return
+    if current not in [tag.strip() for tag in if_match.split(",")]:
+        raise HTTPException(status_code=412, detail="Resource was modified by someone else, reload and retry")
+
+
+def check_version(path: str, if_match: Optional[str]):
+    """Raise 412 when the client edited an older version than the one on disk."""
+    check_etag(version(path), if_match)
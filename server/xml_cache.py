@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import threading
+
+import storage
+
+# Serialised <faktura-prijata> fragments of earlier FlexiBee exports. A
+# fragment is keyed by the hash of the invoice JSON plus the hash of its
+# attachment, so an unchanged invoice is exported again by copying bytes and
+# an edited one (or one whose scan was replaced) simply misses the cache.
+# Fragments live in CACHE_DIR; when they exceed the size limit the least
+# recently used ones are removed.
+CACHE_DIR = "data/xml_fragments"
+MAX_BYTES = int(os.environ.get("XML_CACHE_MB", 1024)) * 1024 * 1024
+# Bump when the fragment layout changes so old fragments are not reused
+FORMAT_VERSION = 1
+READ_CHUNK = 1024 * 1024
+
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "stored": 0, "evicted": 0}
+_size = None  # bytes in CACHE_DIR, counted on first use
+
+
+def key(invoice: dict, attachment_hash: str = "") -> str:
+    """Cache key of an invoice: its JSON content plus the attachment's content hash."""
+    canonical = json.dumps(invoice, sort_keys=True, ensure_ascii=False)
+    raw = f"{FORMAT_VERSION}\0{canonical}\0{attachment_hash}".encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+def _path(cache_key: str) -> str:
+    return os.path.join(CACHE_DIR, f"{cache_key}.xml")
+
+
+def _entries() -> list:
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if not name.endswith(".xml"):
+            continue
+        try:
+            stat = os.stat(os.path.join(CACHE_DIR, name))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+    return entries
+
+
+def _account(added: int):
+    """Count a new fragment and evict least recently used ones above MAX_BYTES."""
+    global _size
+    with _lock:
+        if _size is None:
+            _size = sum(size for _, size, _ in _entries())
+        else:
+            _size += added
+        if _size <= MAX_BYTES:
+            return
+        # Other workers write here too, so evict from what is actually on disk
+        entries = sorted(_entries())
+        _size = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if _size <= MAX_BYTES:
+                break
+            try:
+                os.remove(os.path.join(CACHE_DIR, name))
+            except FileNotFoundError:
+                continue
+            _size -= size
+            _stats["evicted"] += 1
+
+
+def iter_fragment(cache_key: str, build):
+    """Yield the cached fragment, or the chunks of build() while storing them."""
+    path = _path(cache_key)
+    try:
+        cached = open(path, "rb")
+    except FileNotFoundError:
+        cached = None
+
+    if cached is not None:
+        with _lock:
+            _stats["hits"] += 1
+        with cached:
+            try:
+                os.utime(path)  # mtime is the LRU clock
+            except OSError:
+                pass
+            while chunk := cached.read(READ_CHUNK):
+                yield chunk
+        return
+
+    with _lock:
+        _stats["misses"] += 1
+    # An export that is cancelled half-way leaves no partial fragment
+    with storage.open_atomic(path, fsync=False) as f:
+        for chunk in build():
+            f.write(chunk)
+            yield chunk
+        size = f.tell()
+    if size > MAX_BYTES:
+        os.remove(path)
+        return
+    with _lock:
+        _stats["stored"] += 1
+    _account(size)
+
+
+def clear() -> int:
+    global _size
+    with _lock:
+        removed = 0
+        for _, _, name in _entries():
+            try:
+                os.remove(os.path.join(CACHE_DIR, name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+        _size = 0
+    return removed
+
+
+def stats() -> dict:
+    entries = _entries()
+    with _lock:
+        requests = _stats["hits"] + _stats["misses"]
+        return {
+            "fragments": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "maxBytes": MAX_BYTES,
+            "hitRate": round(_stats["hits"] / requests, 3) if requests else None,
+            **_stats,
+        }